@@ -9,14 +9,20 @@ import re
 import io
 import wave
 import shutil
+import socket
 import math
 import zipfile
-from typing import Optional, Tuple, Literal
+import zlib
+import hashlib
+import unicodedata
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple, Literal, NamedTuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import requests
-from flask import Flask, request, redirect, url_for, render_template_string
+from flask import Flask, request, redirect, url_for, render_template_string, jsonify
 
 import numpy as np
 import sounddevice as sd
@@ -51,15 +57,93 @@ if env_vosk_dir:
 
 # Configuración de audio basada en ejemplo probado
 sd.default.device = 'rockchip,es8388'
-SAMPLE_RATE = 16000
-BLOCKSIZE = 8000
+SAMPLE_RATE = 16000  # frecuencia que reciben los reconocedores (Vosk/Kaldi)
+# Frecuencia nativa del micrófono; se detecta en ensure_paths() y se remuestrea a SAMPLE_RATE
+CAPTURE_RATE = int(os.getenv("CAPTURE_RATE", "0")) or SAMPLE_RATE
+# Bloque del dispositivo: 20-50 ms = baja latencia; 500 equivale al antiguo BLOCKSIZE=8000 @16kHz
+CAPTURE_BLOCK_MS = int(os.getenv("CAPTURE_BLOCK_MS", "40"))
+# Audio mínimo por llamada a AcceptWaveform (los bloques pequeños se agrupan para Kaldi)
+KALDI_CHUNK_MS = int(os.getenv("KALDI_CHUNK_MS", "100"))
+# Bloques pendientes por consumidor; si se llena se descarta el más antiguo (y se cuenta)
+CAPTURE_QUEUE_BLOCKS = int(os.getenv("CAPTURE_QUEUE_BLOCKS", "50"))
 WAKE_WORD = "hola"
-SILENCE_THRESHOLD = 2000  # RMS ~ energía. Ajustar si hace falta
-SILENCE_MS = 2000  # fin por silencio
+# Modo "wake word + comando" en una sola frase ("hola qué hora es")
+WAKE_ONESHOT = os.getenv("WAKE_ONESHOT", "1").lower() in {"1", "true", "yes"}
+# Detector de wake word: "vosk" (gramática, modelo pequeño si existe) o "template" (MFCC + plantillas)
+WAKE_ENGINE = os.getenv("WAKE_ENGINE", "vosk").strip().lower()
+VOSK_WAKE_MODEL_DIR = os.getenv("VOSK_WAKE_MODEL_DIR", os.path.join(BASE_DIR, "models", "vosk-small"))
+WAKE_TEMPLATES_DIR = os.getenv("WAKE_TEMPLATES_DIR", os.path.join(BASE_DIR, "wake_templates"))
+WAKE_TEMPLATE_THRESHOLD = float(os.getenv("WAKE_TEMPLATE_THRESHOLD", "0.75"))  # similitud coseno media
+# VAD por tramas (ver FrameVAD)
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "20"))  # tramas de 10-30 ms
+VAD_SNR_DB = float(os.getenv("VAD_SNR_DB", "9.0"))  # dB sobre el suelo de ruido para p=0.5
+VAD_ON = float(os.getenv("VAD_ON", "0.6"))  # histéresis: entra en voz por encima de esta probabilidad
+VAD_OFF = float(os.getenv("VAD_OFF", "0.35"))  # ... y sale por debajo de esta
+# Endpointing adaptativo del comando (ver Endpointer)
+ENDPOINT_SILENCE_MS = int(os.getenv("ENDPOINT_SILENCE_MS", "900"))  # silencio final sin más pistas
+ENDPOINT_FAST_MS = int(os.getenv("ENDPOINT_FAST_MS", "250"))  # silencio final si la frase ya parece completa
+ENDPOINT_STABLE_MS = int(os.getenv("ENDPOINT_STABLE_MS", "500"))  # parcial de Vosk sin cambios durante este tiempo
+ENDPOINT_NO_SPEECH_MS = int(os.getenv("ENDPOINT_NO_SPEECH_MS", "5000"))  # nadie habla tras activar
+EARCON_ECHO_MS = int(os.getenv("EARCON_ECHO_MS", "150"))  # cola del beep que aún puede llegar al micro
 MAX_COMMAND_SECS = 12
+# Primera pasada con gramática de frases conocidas (ver COMMAND_PHRASES); necesita el modelo pequeño
+COMMAND_GRAMMAR = os.getenv("COMMAND_GRAMMAR", "1").lower() in {"1", "true", "yes"}
+COMMAND_GRAMMAR_MIN_CONF = float(os.getenv("COMMAND_GRAMMAR_MIN_CONF", "0.8"))  # confianza mínima por palabra
+# Clasificación especulativa sobre el parcial estable (ver SpeculativeIntent)
+SPECULATIVE = os.getenv("SPECULATIVE", "1").lower() in {"1", "true", "yes"}
+SPECULATIVE_STABLE_MS = int(os.getenv("SPECULATIVE_STABLE_MS", "300"))  # parcial sin cambios antes de lanzarla
+SPECULATIVE_PREFILL = os.getenv("SPECULATIVE_PREFILL", "1").lower() in {"1", "true", "yes"}  # precargar el prompt en Ollama
+# Si la intención es dudosa, pedir la respuesta general mientras la IA clasifica
+PARALLEL_ANSWER = os.getenv("PARALLEL_ANSWER", "1").lower() in {"1", "true", "yes"}
+# Enrutador local de intenciones (ver IntentRouter): la IA solo clasifica en la banda dudosa
+INTENT_EXAMPLES_PATH = os.getenv("INTENT_EXAMPLES_PATH", os.path.join(BASE_DIR, "intent_examples.json"))
+INTENT_INDEX_PATH = os.getenv("INTENT_INDEX_PATH", os.path.join(BASE_DIR, "models", "intent_index.npz"))
+ROUTER_DIMS = int(os.getenv("ROUTER_DIMS", "4096"))
+ROUTER_ACCEPT = float(os.getenv("ROUTER_ACCEPT", "0.6"))  # similitud para decidir sin IA
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", "0.1"))  # ventaja mínima sobre la segunda intención
+ROUTER_OTHER = float(os.getenv("ROUTER_OTHER", "0.2"))  # por debajo, nada se parece: "other"
+# Compuerta de energía delante del reconocedor de wake word (ver WakeGate)
+WAKE_GATE = os.getenv("WAKE_GATE", "1").lower() in {"1", "true", "yes"}
+WAKE_GATE_LOOKBACK_MS = int(os.getenv("WAKE_GATE_LOOKBACK_MS", "300"))  # audio previo al inicio de voz
+WAKE_GATE_HANGOVER_MS = int(os.getenv("WAKE_GATE_HANGOVER_MS", "800"))  # silencio antes de cerrar la compuerta
+# Salida de audio persistente: un único aplay abierto desde el arranque que
+# reciben respuestas, avisos y pitidos (sin lanzar procesos en cada turno)
+AUDIO_SINK = os.getenv("AUDIO_SINK", "1").lower() in {"1", "true", "yes"}
+SINK_LEAD_MS = int(os.getenv("SINK_LEAD_MS", "120"))  # audio escrito por delante de lo que suena
+SINK_IDLE_PAD_SECS = float(os.getenv("SINK_IDLE_PAD_SECS", "30"))  # silencio de relleno tras el último audio
+AUDIO_BACKEND = os.getenv("AUDIO_BACKEND", "sounddevice").strip().lower()  # sounddevice | aplay
+AUDIO_ROUTE_PATH = os.getenv("AUDIO_ROUTE_PATH", os.path.join(BASE_DIR, "models", "audio_route.json"))
+# Síntesis con anticipación: las frases siguientes se sintetizan mientras suena la actual
+TTS_LOOKAHEAD = int(os.getenv("TTS_LOOKAHEAD", "2"))  # frases sintetizándose a la vez
+TTS_THREADS = int(os.getenv("TTS_THREADS", "0")) or max(1, (os.cpu_count() or 2) - 1)  # hilos de onnxruntime para la voz
+TTS_READAHEAD_SECS = float(os.getenv("TTS_READAHEAD_SECS", "6"))  # audio sintetizado por delante como máximo
+# Segundos de audio que se conservan en el buffer circular de pre-roll
+PREROLL_SECS = float(os.getenv("PREROLL_SECS", "5.0"))
 OLLAMA_MODEL = "llama3.2:3b"
+# Modelo pequeño para clasificar y formatear (ver TASK_PROFILES); vacío = todo al principal
+OLLAMA_FAST_MODEL = os.getenv("OLLAMA_FAST_MODEL", "llama3.2:1b").strip()
 # Permite configurar el endpoint de Ollama, p.ej.: OLLAMA_HOST="http://127.0.0.1:11434"
 OLLAMA_HOST = "http://192.168.1.165:11434"
+# Varios servidores separados por comas; se usa el más rápido de los sanos (ver OllamaPool)
+OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", "").split(",") if h.strip()] or [OLLAMA_HOST]
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "2.0"))  # s para conectar / health check
+OLLAMA_STALL_SECS = float(os.getenv("OLLAMA_STALL_SECS", "10.0"))  # s sin recibir nada = servidor atascado
+OLLAMA_HEALTH_SECS = float(os.getenv("OLLAMA_HEALTH_SECS", "30.0"))  # intervalo de comprobación de salud
+# Presupuesto de latencia por turno: fin de la frase → empieza a sonar la respuesta (ver TurnBudget)
+TURN_BUDGET_SECS = float(os.getenv("TURN_BUDGET_SECS", "12.0"))
+# Circuit breakers de servicios remotos (ver CircuitBreaker)
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "2"))  # fallos seguidos para abrirlo
+BREAKER_COOLDOWN_SECS = float(os.getenv("BREAKER_COOLDOWN_SECS", "30.0"))  # tiempo abierto antes de probar
+# Tiempo que Ollama mantiene el modelo cargado tras cada petición ("30m", "2h"; un número son
+# segundos y -1 = siempre)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m").strip()
+if re.fullmatch(r"-?\d+", OLLAMA_KEEP_ALIVE):
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)  # type: ignore[assignment]
+# Historial de conversación (ver ConversationSession)
+SESSION_MAX_TOKENS = int(os.getenv("SESSION_MAX_TOKENS", "1024"))  # tokens aprox. de turnos + resumen
+SESSION_IDLE_SECS = float(os.getenv("SESSION_IDLE_SECS", "300"))  # inactividad que reinicia la conversación
+# load_duration a partir del cual una petición cuenta como "en frío"
+OLLAMA_COLD_LOAD_MS = float(os.getenv("OLLAMA_COLD_LOAD_MS", "500"))
 # Prompt del sistema. Busca respuestas directas, sin saludos ni autorreferencias
 OLLAMA_PROMPT = os.getenv(
     "OLLAMA_PROMPT",
@@ -91,21 +175,317 @@ def _load_ollama_options() -> dict:
 
 OLLAMA_OPTIONS = _load_ollama_options()
 
+def _estimate_tokens(text: str) -> int:
+    # Aproximación para español (~3 caracteres por token); basta para acotar la ventana
+    return len(text or "") // 3 + 1
+
+
+class ConversationSession:
+    """Conversación multi-turno acotada para las preguntas a la IA.
+
+    Orden de los mensajes: prompt del sistema (siempre byte a byte igual, para
+    que Ollama reutilice su caché de prefijo), resumen de turnos antiguos y
+    los últimos turnos. Si la ventana supera SESSION_MAX_TOKENS se recorta de
+    golpe la mitad más antigua (recortar un turno cada vez cambiaría el
+    prefijo en cada petición) y se resume en segundo plano. Tras
+    SESSION_IDLE_SECS sin hablar se empieza de cero.
+    """
+
+    def __init__(self, system_prompt: str, max_tokens: int = SESSION_MAX_TOKENS,
+                 idle_secs: float = SESSION_IDLE_SECS) -> None:
+        self._lock = threading.Lock()
+        self._summarizing = threading.Lock()  # un resumen a la vez, cada uno parte del anterior
+        self._system = system_prompt.strip()
+        self.max_tokens = int(max_tokens)
+        self.idle_secs = float(idle_secs)
+        self._summary = ""
+        self._turns: list = []  # [(usuario, asistente)]
+        self._last_ts = 0.0
+
+    def _expire(self) -> None:
+        if self._turns and time.time() - self._last_ts > self.idle_secs:
+            print("[Sesión] Inactiva; empieza una conversación nueva")
+            self._turns.clear()
+            self._summary = ""
+
+    def messages(self, user_message: str) -> list:
+        with self._lock:
+            self._expire()
+            messages = []
+            if self._system:
+                messages.append({"role": "system", "content": self._system})
+            if self._summary:
+                messages.append({"role": "system", "content": f"Resumen de la conversación anterior: {self._summary}"})
+            for user, assistant in self._turns:
+                messages.append({"role": "user", "content": user})
+                messages.append({"role": "assistant", "content": assistant})
+            messages.append({"role": "user", "content": user_message})
+            return messages
+
+    def record(self, user_message: str, reply: str) -> None:
+        """Añade un turno terminado y recorta la ventana si hace falta."""
+        if not user_message or not reply:
+            return
+        with self._lock:
+            self._expire()
+            self._turns.append((user_message.strip(), reply.strip()))
+            self._last_ts = time.time()
+            used = sum(_estimate_tokens(u) + _estimate_tokens(a) for u, a in self._turns) + _estimate_tokens(self._summary)
+            if used <= self.max_tokens or len(self._turns) < 2:
+                return
+            cut = len(self._turns) // 2
+            old, self._turns = self._turns[:cut], self._turns[cut:]
+        print(f"[Sesión] Ventana llena (~{used} tokens); resumiendo {len(old)} turnos antiguos")
+        threading.Thread(target=self._summarize, args=(old,), daemon=True).start()
+
+    def _summarize(self, turns: list) -> None:
+        with self._summarizing:
+            with self._lock:
+                previous = self._summary
+            summary = self._summarize_text(previous, turns)
+            if summary:
+                with self._lock:
+                    self._summary = summary
+
+    @staticmethod
+    def _summarize_text(previous: str, turns: list) -> str:
+        lines = [f"Usuario: {u}\nAsistente: {a}" for u, a in turns]
+        if previous:
+            lines.insert(0, f"Resumen previo: {previous}")
+        summary = _ollama_chat([
+            {"role": "system", "content": (
+                "Resume en español, en 2-3 frases, los datos de esta conversación que sirvan para "
+                "entender preguntas posteriores. Solo el resumen, sin introducciones."
+            )},
+            {"role": "user", "content": "\n".join(lines)},
+        ], task="session_summary")
+        if not summary or isinstance(summary, FailedReply):
+            return ""
+        return summary
+
+    def reset(self) -> None:
+        with self._lock:
+            self._turns.clear()
+            self._summary = ""
+
+
+_session = ConversationSession(OLLAMA_PROMPT)
+
+
 def build_ollama_messages(user_message: str) -> list:
-    """Construye los mensajes para enviar a Ollama incluyendo el prompt del sistema."""
-    messages = []
-    if OLLAMA_PROMPT.strip():
-        messages.append({"role": "system", "content": OLLAMA_PROMPT.strip()})
-    messages.append({"role": "user", "content": user_message})
-    return messages
+    """Construye los mensajes para enviar a Ollama: prompt del sistema, historial
+    reciente de la sesión y el mensaje del usuario."""
+    return _session.messages(user_message)
 
 _piper_voice = None  # Lazy init para fallback Python
 _vosk_model: Optional[vosk.Model] = None  # Reutilizar modelo en memoria
+_vosk_wake_model: Optional[vosk.Model] = None  # Modelo pequeño solo para la wake word
 _config: dict = {}
 
 IntentType = Literal["weather", "time", "other"]
 
 
+class Metrics:
+    """Contadores y tiempos en memoria para diagnóstico (thread-safe).
+
+    Los contadores acumulan (p.ej. segundos de audio); los tiempos guardan
+    n/media/mín/máx/último de cada nombre. Se consultan en /metrics.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict = {}
+        self._timings: dict = {}
+        self._gauges: dict = {}
+
+    def incr(self, name: str, value: float = 1.0) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0.0) + value
+
+    def observe(self, name: str, value_ms: float) -> None:
+        with self._lock:
+            t = self._timings.get(name)
+            if t is None:
+                t = self._timings[name] = {"n": 0, "sum": 0.0, "min": value_ms, "max": value_ms, "last": value_ms}
+            t["n"] += 1
+            t["sum"] += value_ms
+            t["min"] = min(t["min"], value_ms)
+            t["max"] = max(t["max"], value_ms)
+            t["last"] = value_ms
+
+    def set(self, name: str, value) -> None:
+        """Valor instantáneo (p.ej. estado de un circuit breaker)."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0.0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            timings = {
+                k: {"n": v["n"], "avg_ms": round(v["sum"] / v["n"], 2), "min_ms": round(v["min"], 2),
+                    "max_ms": round(v["max"], 2), "last_ms": round(v["last"], 2)}
+                for k, v in self._timings.items()
+            }
+            return {"counters": {k: round(v, 3) for k, v in self._counters.items()}, "timings": timings,
+                    "gauges": dict(self._gauges)}
+
+
+_metrics = Metrics()
+
+
+# =====================
+# Presupuesto por turno y circuit breakers
+# =====================
+
+class DeadlineExceeded(Exception):
+    """Se agotó el presupuesto de latencia del turno."""
+
+
+class BackendUnavailable(Exception):
+    """Ningún servidor disponible (circuit breakers abiertos)."""
+
+
+class TurnBudget:
+    """Presupuesto de latencia de un turno: desde que el usuario termina de
+    hablar hasta que empieza a sonar la respuesta (TURN_BUDGET_SECS).
+
+    Cada etapa (STT, clasificación, consulta externa, IA, TTS) limita sus
+    esperas con timeout() y anota su duración con stage(). Una vez que suena
+    audio la respuesta ya no se corta por presupuesto.
+    """
+
+    def __init__(self, secs: float = TURN_BUDGET_SECS) -> None:
+        self.started = time.monotonic()
+        self.deadline = self.started + float(secs)
+        self.speaking = False
+        self._last = self.started
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        return not self.speaking and self.remaining() <= 0
+
+    def timeout(self, cap: float) -> float:
+        """Timeout para una espera: el menor entre 'cap' y lo que queda (mín. 0.1 s)."""
+        if self.speaking:
+            return cap
+        return max(0.1, min(cap, self.remaining()))
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            _metrics.incr(f"turn.deadline_{stage}")
+            raise DeadlineExceeded(f"presupuesto agotado en {stage}")
+
+    def stage(self, name: str) -> None:
+        now = time.monotonic()
+        _metrics.observe(f"turn.{name}_ms", 1000.0 * (now - self._last))
+        self._last = now
+
+    def first_audio(self) -> None:
+        if not self.speaking:
+            self.speaking = True
+            _metrics.observe("turn.first_audio_ms", 1000.0 * (time.monotonic() - self.started))
+
+
+_turn_budget: Optional[TurnBudget] = None
+
+
+def begin_turn() -> TurnBudget:
+    """Arranca el presupuesto del turno (al terminar de hablar el usuario)."""
+    global _turn_budget
+    _turn_budget = TurnBudget()
+    return _turn_budget
+
+
+def end_turn() -> None:
+    global _turn_budget
+    _turn_budget = None
+
+
+def current_budget() -> Optional[TurnBudget]:
+    """Presupuesto del turno en curso (None fuera de un turno: arranque, especulación...)."""
+    return _turn_budget
+
+
+def budget_timeout(cap: float) -> float:
+    budget = _turn_budget
+    return budget.timeout(cap) if budget is not None else cap
+
+
+class CircuitBreaker:
+    """Circuit breaker por servicio remoto.
+
+    closed: todo pasa. Tras BREAKER_FAILURES fallos seguidos pasa a open y
+    rechaza al instante durante BREAKER_COOLDOWN_SECS. Después queda half-open:
+    deja pasar una sola petición de prueba; si sale bien vuelve a closed, si
+    falla vuelve a open. El estado se publica en /metrics (gauges).
+    """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN_SECS) -> None:
+        self.name = name
+        self.max_failures = max(1, int(failures))
+        self.cooldown = float(cooldown)
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        _metrics.set(f"breaker.{name}", self._state)
+
+    def _set(self, state: str) -> None:
+        if state != self._state:
+            print(f"[Breaker] {self.name}: {self._state} → {state}")
+            self._state = state
+            _metrics.set(f"breaker.{self.name}", state)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self._set("half_open")
+            return self._state
+
+    def available(self) -> bool:
+        """¿Se le puede enviar una petición? (sin reservar la prueba de half-open)"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self._probing)
+
+    def acquire(self) -> bool:
+        """Reserva el paso para una petición; en half-open solo una a la vez."""
+        state = self.state
+        with self._lock:
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+        _metrics.incr(f"breaker.{self.name}.rejected")
+        return False
+
+    def release(self) -> None:
+        """Libera la prueba de half-open sin decidir (petición abandonada)."""
+        with self._lock:
+            self._probing = False
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set("closed")
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.max_failures:
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._set("open")
+
+
 def load_config() -> dict:
     """Carga configuración desde config.json y variables de entorno.
     Campos: owm_api_key, city, lat, lon, timezone (IANA).
@@ -170,6 +550,179 @@ def detect_intent(text: str) -> Tuple[IntentType, dict]:
     return "other", extras
 
 
+def _build_command_phrases() -> dict:
+    """Frases habituales que los manejadores nativos aceptan tal cual.
+    Devuelve {frase: (intent, extras)}; de aquí sale la gramática de la primera pasada."""
+    phrases: dict = {}
+    for p in ("qué hora es", "dime la hora", "me dices la hora", "qué hora tienes", "hora actual", "la hora"):
+        phrases[p] = ("time", {})
+    weather = (
+        "qué tiempo hace", "qué tiempo va a hacer", "qué tiempo hará", "cómo está el tiempo",
+        "cómo está el clima", "qué temperatura hace", "cuál es la temperatura", "va a llover",
+        "llueve", "hace viento", "el tiempo", "el clima", "pronóstico del tiempo",
+    )
+    for base in weather:
+        for suffix, when in (("", None), (" hoy", "now"), (" ahora", "now"), (" mañana", "tomorrow")):
+            phrases[base + suffix] = ("weather", {"when": when} if when else {})
+    # Preguntas fijas: respuesta directa sin pasar por la IA
+    for p in ("cómo te llamas", "quién eres", "cuál es tu nombre"):
+        phrases[p] = ("other", {"reply": "Soy Kubik, tu asistente virtual."})
+    return phrases
+
+
+COMMAND_PHRASES = _build_command_phrases()
+
+
+def match_command_phrase(text: str) -> Optional[Tuple[IntentType, dict]]:
+    """Intención determinista si el texto es exactamente una frase conocida."""
+    t = re.sub(r"\s+", " ", (text or "").lower()).strip()
+    hit = COMMAND_PHRASES.get(t)
+    if hit is None:
+        return None
+    return hit[0], dict(hit[1])
+
+
+# Frases de ejemplo por intención para el enrutador local (ver IntentRouter).
+# Se pueden añadir más (o intenciones nuevas) en intent_examples.json: {"intent": ["frase", ...]}
+INTENT_EXAMPLES = {
+    "time": [
+        "qué hora es", "dime la hora", "me dices la hora", "qué hora tienes", "sabes qué hora es",
+        "la hora por favor", "qué hora es ahora mismo", "hora actual", "a qué hora estamos",
+    ],
+    "weather": [
+        "qué tiempo hace", "qué tiempo va a hacer mañana", "cómo está el clima hoy", "va a llover mañana",
+        "qué temperatura hace fuera", "cuántos grados hace", "hace frío hoy", "hace calor ahora",
+        "necesito paraguas", "está lloviendo", "pronóstico del tiempo para mañana", "hace viento hoy",
+        "cómo va a estar el día", "qué humedad hay", "está nublado", "lloverá esta semana", "hará sol mañana",
+    ],
+    "other": [
+        "cuéntame un chiste", "quién escribió el quijote", "cuánto es dos más dos", "qué es un agujero negro",
+        "cómo se hace una tortilla", "quién eres", "traduce hola al inglés", "cuál es la capital de francia",
+        "recomiéndame una película", "por qué el cielo es azul", "háblame de la historia de roma",
+        "cuántos años tiene la tierra", "dame una idea para cenar",
+    ],
+}
+
+
+class IntentRouter:
+    """Clasificador local de intenciones por similitud con frases de ejemplo.
+
+    Cada frase se representa con n-gramas de caracteres (3-4) y palabras,
+    proyectados por hash a ROUTER_DIMS dimensiones y normalizados; la
+    intención es la del ejemplo más parecido (coseno, un producto matriz-
+    vector en NumPy). El índice se guarda en INTENT_INDEX_PATH y se
+    reconstruye solo si cambian los ejemplos.
+    """
+
+    def __init__(self, examples: dict, path: str = INTENT_INDEX_PATH, dims: int = ROUTER_DIMS) -> None:
+        self.dims = int(dims)
+        self.path = path
+        texts = [t for label in sorted(examples) for t in examples[label]]
+        labels = [label for label in sorted(examples) for _ in examples[label]]
+        key = hashlib.sha1(json.dumps([self.dims, labels, texts], ensure_ascii=False).encode("utf-8")).hexdigest()
+        self.labels = np.array(labels)
+        self.matrix = self._load(key)
+        if self.matrix is None:
+            self.matrix = np.vstack([self.embed(t) for t in texts]) if texts else np.zeros((0, self.dims), np.float32)
+            self._save(key)
+
+    def _load(self, key: str) -> Optional[np.ndarray]:
+        try:
+            with np.load(self.path) as data:
+                if str(data["key"]) == key:
+                    return data["matrix"]
+        except Exception:
+            pass
+        return None
+
+    def _save(self, key: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            np.savez(self.path, key=np.array(key), matrix=self.matrix)
+        except Exception as exc:
+            print(f"[Intent] No se pudo guardar el índice en {self.path}: {exc}")
+
+    def embed(self, text: str) -> np.ndarray:
+        t = unicodedata.normalize("NFKD", _normalize_transcript(text))
+        t = "".join(c for c in t if not unicodedata.combining(c))
+        padded = f" {t} "
+        feats = [padded[i:i + n] for n in (3, 4) for i in range(len(padded) - n + 1)]
+        feats += [f"w:{w}" for w in t.split()]
+        vec = np.zeros(self.dims, dtype=np.float32)
+        if feats:
+            idx = np.fromiter((zlib.crc32(f.encode("utf-8")) % self.dims for f in feats), dtype=np.int64, count=len(feats))
+            np.add.at(vec, idx, 1.0)
+            vec /= np.linalg.norm(vec)
+        return vec
+
+    def scores(self, text: str) -> dict:
+        """Mejor similitud por intención."""
+        if self.matrix.shape[0] == 0:
+            return {}
+        sims = self.matrix @ self.embed(text)
+        return {str(label): float(sims[self.labels == label].max()) for label in np.unique(self.labels)}
+
+
+_intent_router: Optional[IntentRouter] = None
+
+
+def _load_intent_examples() -> dict:
+    examples = {k: list(v) for k, v in INTENT_EXAMPLES.items()}
+    try:
+        if os.path.isfile(INTENT_EXAMPLES_PATH):
+            with open(INTENT_EXAMPLES_PATH, "r", encoding="utf-8") as fh:
+                extra = json.load(fh) or {}
+            for label, phrases in extra.items():
+                examples.setdefault(str(label), []).extend(str(p) for p in phrases)
+    except Exception as exc:
+        print(f"[Intent] No se pudo leer {INTENT_EXAMPLES_PATH}: {exc}")
+    return examples
+
+
+def get_intent_router() -> IntentRouter:
+    global _intent_router
+    if _intent_router is None:
+        t0 = time.perf_counter()
+        _intent_router = IntentRouter(_load_intent_examples())
+        _metrics.observe("startup.intent_router_ms", 1000.0 * (time.perf_counter() - t0))
+    return _intent_router
+
+
+def route_intent(text: str) -> Optional[Tuple[IntentType, dict]]:
+    """Intención decidida solo con el enrutador local, o None si es dudosa.
+
+    Seguro: similitud >= ROUTER_ACCEPT y con ROUTER_MARGIN de ventaja sobre la
+    segunda intención. Sin parecido con ningún ejemplo (< ROUTER_OTHER): "other".
+    En medio: None (hay que preguntar a la IA).
+    """
+    t0 = time.perf_counter()
+    scores = get_intent_router().scores(text)
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    _metrics.observe("router.classify_ms", 1000.0 * (time.perf_counter() - t0))
+    best, best_score = ranked[0] if ranked else ("other", 0.0)
+    second = ranked[1][1] if len(ranked) > 1 else 0.0
+    if best_score >= ROUTER_ACCEPT and best_score - second >= ROUTER_MARGIN:
+        _metrics.incr("router.hits")
+        intent: IntentType = best if best in {"weather", "time"} else "other"  # type: ignore[assignment]
+        # El marco temporal sale de las palabras clave ("mañana", "hoy"...)
+        _, extras = detect_intent(text)
+        print(f"[Intent] Enrutador local → {best} ({best_score:.2f}, margen {best_score - second:.2f})")
+        return intent, extras if intent == "weather" else {}
+    if best_score < ROUTER_OTHER:
+        _metrics.incr("router.hits")
+        print(f"[Intent] Enrutador local → other (sin parecido, {best_score:.2f})")
+        return "other", {}
+    _metrics.incr("router.llm_fallbacks")
+    print(f"[Intent] Enrutador local dudoso ({best} {best_score:.2f}); consultando a la IA")
+    return None
+
+
+def classify_intent(text: str) -> Tuple[IntentType, dict]:
+    """Intención con el enrutador local; la IA solo decide en la banda ambigua."""
+    routed = route_intent(text)
+    return routed if routed is not None else classify_intent_via_llm(text)
+
+
 def classify_intent_via_llm(text: str) -> Tuple[IntentType, dict]:
     """Pide a la IA que clasifique la intención y el marco temporal.
     Devuelve (intent, extras) donde intent ∈ {weather,time,other} y extras puede incluir 'when'.
@@ -184,12 +737,13 @@ def classify_intent_via_llm(text: str) -> Tuple[IntentType, dict]:
         "No añadas texto adicional ni explicaciones."
     )
     user = text.strip()
-    resp = _ollama_chat([{"role": "system", "content": system}, {"role": "user", "content": user}])
+    resp = _ollama_chat([{"role": "system", "content": system}, {"role": "user", "content": user}], task="classify")
     intent: IntentType = "other"
     extras: dict = {}
-    # Intentar parsear JSON
+    # Intentar parsear JSON (los modelos pequeños a veces lo envuelven en ```json … ```)
     try:
-        data = json.loads(resp)
+        match = re.search(r"\{.*?\}", resp or "", re.S)
+        data = json.loads(match.group(0) if match else resp)
         val = str(data.get("intent", "other")).strip().lower()
         if val in {"weather", "time", "other"}:
             intent = val  # type: ignore[assignment]
@@ -213,18 +767,475 @@ def classify_intent_via_llm(text: str) -> Tuple[IntentType, dict]:
     return intent, extras
 
 
-def _ollama_chat(messages: list) -> str:
-    """Llama a Ollama de forma no streaming y devuelve el texto completo."""
+# Respuesta HTTP en curso de cada hilo, para poder abortar un stream desde
+# otro hilo (el generador de ollama no se puede cerrar mientras se itera)
+_http_local = threading.local()
+
+
+def _on_http_response(response) -> None:
+    hook = getattr(_http_local, "on_response", None)
+    if hook is not None:
+        hook(response)
+
+
+class OllamaBackend:
+    """Un servidor de Ollama: cliente propio (conexiones reutilizadas), salud y
+    medias móviles de tiempo hasta el primer token y tokens/s."""
+
+    def __init__(self, host: str) -> None:
+        self.host = host.rstrip("/")
+        self.name = self.host.split("//")[-1]  # para métricas y logs
+        try:
+            import httpx  # dependencia de ollama
+            timeout = httpx.Timeout(OLLAMA_STALL_SECS, connect=OLLAMA_CONNECT_TIMEOUT)
+        except Exception:
+            timeout = OLLAMA_STALL_SECS
+        # Timeout de lectura = tiempo máximo sin recibir nada (stream atascado)
+        self.client = ollama.Client(host=self.host, timeout=timeout,
+                                    event_hooks={"response": [_on_http_response]})
+        self.healthy = True
+        self.failures = 0
+        self.breaker = CircuitBreaker(f"ollama@{self.name}")
+        self.ttft_ms: Optional[float] = None
+        self.tps: Optional[float] = None
+
+    def observe(self, ttft_ms: Optional[float], tps: Optional[float]) -> None:
+        a = 0.3
+        if ttft_ms is not None:
+            self.ttft_ms = ttft_ms if self.ttft_ms is None else (1 - a) * self.ttft_ms + a * ttft_ms
+        if tps:
+            self.tps = tps if self.tps is None else (1 - a) * self.tps + a * tps
+
+    def score(self) -> float:
+        """Tiempo estimado (ms) para una respuesta típica; sin datos = 0 para probarlo."""
+        if self.ttft_ms is None or not self.tps:
+            return 0.0
+        return self.ttft_ms + 1000.0 * 60 / self.tps
+
+
+class OllamaPool:
+    """Varios servidores de Ollama (OLLAMA_HOSTS) con comprobación de salud.
+
+    Cada petición va al servidor sano con mejor estimación (primer token +
+    tokens/s medidos). Si uno falla o su stream se queda OLLAMA_STALL_SECS sin
+    entregar nada, se marca caído y la petición sigue en el siguiente: en un
+    stream ya empezado, el texto recibido se envía como inicio del mensaje del
+    asistente para que continúe donde se quedó. Los caídos se vuelven a
+    comprobar cada OLLAMA_HEALTH_SECS.
+    """
+
+    def __init__(self, hosts: list, model: str = OLLAMA_MODEL) -> None:
+        self.model = model
+        self.backends = [OllamaBackend(h) for h in hosts]
+        self._lock = threading.Lock()
+        self._checker: Optional[threading.Thread] = None
+
+    def check(self, backend: OllamaBackend) -> bool:
+        """Salud = responde /api/tags y tiene el modelo."""
+        try:
+            resp = requests.get(f"{backend.host}/api/tags", timeout=OLLAMA_CONNECT_TIMEOUT)
+            resp.raise_for_status()
+            names = {str(m.get("name") or m.get("model") or "") for m in resp.json().get("models", [])}
+            ok = self.model in names or f"{self.model}:latest" in names
+        except Exception:
+            ok = False
+        with self._lock:
+            if ok and not backend.healthy:
+                print(f"[Ollama] {backend.host} vuelve a estar disponible")
+            backend.healthy = ok
+        return ok
+
+    def start_health_checks(self) -> None:
+        if self._checker is not None:
+            return
+
+        def loop() -> None:
+            while True:
+                for backend in self.backends:
+                    self.check(backend)
+                time.sleep(OLLAMA_HEALTH_SECS)
+
+        self._checker = threading.Thread(target=loop, daemon=True)
+        self._checker.start()
+
+    def mark_failed(self, backend: OllamaBackend, exc: Exception) -> None:
+        with self._lock:
+            backend.healthy = False
+            backend.failures += 1
+        backend.breaker.failure()
+        _metrics.incr("ollama.failovers")
+        print(f"[Ollama] {backend.host} falla ({exc}); probando otro servidor")
+
+    def ranked(self, exclude: Optional[set] = None) -> list:
+        """Servidores a probar, el mejor primero. Los de breaker abierto no
+        cuentan; si los que quedan parecen caídos se intentan igualmente."""
+        exclude = exclude or set()
+        with self._lock:
+            candidates = [b for b in self.backends if b.host not in exclude and b.breaker.available()]
+            healthy = [b for b in candidates if b.healthy]
+        return sorted(healthy or candidates, key=lambda b: b.score())
+
+    @staticmethod
+    def _abort_on_cancel(cancel: threading.Event, finished: threading.Event, responses: list) -> None:
+        """Cierra la respuesta HTTP en curso en cuanto se cancela la petición."""
+        while not finished.is_set():
+            if cancel.wait(0.05):
+                for response in list(responses):
+                    # close() no despierta un recv() bloqueado en otro hilo; shutdown() sí
+                    try:
+                        sock = response.extensions["network_stream"].get_extra_info("socket")
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except Exception:
+                        pass
+                    try:
+                        response.close()
+                    except Exception:
+                        pass
+                return
+
+    def stream_chat(self, messages: list, options: Optional[dict] = None, model: Optional[str] = None,
+                    cancel: Optional[threading.Event] = None):
+        """Generador de fragmentos de chat con failover. Cerrarlo cierra la
+        conexión en curso (Ollama deja de generar). Con 'cancel', activarlo
+        desde otro hilo aborta la respuesta HTTP sin esperar al siguiente
+        fragmento y no se prueba ningún otro servidor."""
+        options = OLLAMA_OPTIONS if options is None else options
+        model = model or self.model
+        produced = ""
+        tried: set = set()
+        while True:
+            if cancel is not None and cancel.is_set():
+                return
+            budget = current_budget()
+            if budget is not None:
+                budget.check("llm")
+            backend = next((b for b in self.ranked(exclude=tried) if b.breaker.acquire()), None)
+            if backend is None:
+                raise BackendUnavailable("ningún servidor de Ollama disponible")
+            tried.add(backend.host)
+            msgs = messages + [{"role": "assistant", "content": produced}] if produced else messages
+            inner = None
+            t0 = time.perf_counter()
+            ttft_ms: Optional[float] = None
+            finished = threading.Event()
+            if cancel is not None:
+                responses: list = []
+                _http_local.on_response = responses.append
+                threading.Thread(target=self._abort_on_cancel, args=(cancel, finished, responses),
+                                 daemon=True).start()
+            try:
+                inner = backend.client.chat(model=model, messages=msgs, stream=True,
+                                            options=options, keep_alive=OLLAMA_KEEP_ALIVE)
+                for chunk in inner:
+                    if cancel is not None and cancel.is_set():
+                        return
+                    if budget is not None:
+                        budget.check("llm")
+                    piece = chunk.get("message", {}).get("content", "")
+                    if piece:
+                        if ttft_ms is None:
+                            ttft_ms = 1000.0 * (time.perf_counter() - t0)
+                        produced += piece
+                    if chunk.get("done"):
+                        count = float(chunk.get("eval_count") or 0)
+                        secs = float(chunk.get("eval_duration") or 0) / 1e9
+                        if model == self.model:
+                            # El ranking de servidores se basa en el modelo principal
+                            backend.observe(ttft_ms, count / secs if secs > 0 else None)
+                        if ttft_ms is not None:
+                            _metrics.observe(f"ollama.{backend.name}.ttft_ms", ttft_ms)
+                    yield chunk
+                backend.breaker.success()
+                return
+            except DeadlineExceeded:
+                raise
+            except ollama.ResponseError as exc:
+                # Modelo inexistente en el servidor: no es una caída, que decida quien llama
+                if getattr(exc, "status_code", 0) == 404:
+                    raise
+                self.mark_failed(backend, exc)
+            except Exception as exc:
+                if cancel is not None and cancel.is_set():
+                    return  # la conexión la cerramos nosotros: no es un fallo del servidor
+                self.mark_failed(backend, exc)
+            finally:
+                finished.set()
+                _http_local.on_response = None
+                # Presupuesto agotado o stream cancelado: no cuenta ni como éxito ni como fallo
+                backend.breaker.release()
+                try:
+                    close = getattr(inner, "close", None)
+                    if close is not None:
+                        close()
+                except Exception:
+                    pass
+
+    def chat(self, messages: list, options: Optional[dict] = None, model: Optional[str] = None) -> dict:
+        """Petición completa (por debajo va en streaming para detectar atascos).
+        Devuelve el último fragmento con el texto completo en message.content."""
+        text = ""
+        last: dict = {}
+        for chunk in self.stream_chat(messages, options, model):
+            text += chunk.get("message", {}).get("content", "") or ""
+            if chunk.get("done"):
+                last = {k: chunk.get(k) for k in ("load_duration", "prompt_eval_count", "prompt_eval_duration",
+                                                  "eval_count", "eval_duration", "total_duration")}
+        last["message"] = {"role": "assistant", "content": text}
+        return last
+
+    def warm_up(self, backend: OllamaBackend, model: Optional[str] = None) -> dict:
+        return backend.client.chat(model=model or self.model, messages=[], keep_alive=OLLAMA_KEEP_ALIVE)
+
+
+# Perfil de cada tarea: (nivel de modelo, opciones que sustituyen a OLLAMA_OPTIONS).
+# Clasificar y formatear datos piden respuestas cortas y deterministas: van al
+# modelo pequeño con pocos tokens y paradas; las preguntas abiertas, al principal.
+TASK_PROFILES = {
+    "classify": ("fast", {"temperature": 0.0, "num_predict": 40}),
+    "time_summary": ("fast", {"temperature": 0.2, "num_predict": 48}),
+    "weather_summary": ("fast", {"temperature": 0.3, "num_predict": 128}),
+    "session_summary": ("fast", {"temperature": 0.2, "num_predict": 128}),
+    "answer": ("main", {}),
+}
+_disabled_tiers: set = set()  # niveles cuyo modelo no existe en el servidor
+
+
+def _expected_answer_tokens(text: str) -> Optional[int]:
+    """Tope de tokens para una pregunta abierta: las peticiones de explicación
+    usan el num_predict configurado; las preguntas cortas y concretas, menos."""
+    t = _normalize_transcript(text)
+    if re.search(r"\b(expl[ií]ca\w*|cu[eé]ntame|h[aá]blame|describe|resume|por qu[eé]|historia|diferencia)\b", t):
+        return None
+    if len(t.split()) <= 8:
+        return 128
+    return None
+
+
+def select_model(task: str, text: str = "") -> Tuple[str, str, dict]:
+    """Elige (nivel, modelo, opciones) para una tarea."""
+    tier, overrides = TASK_PROFILES.get(task, ("main", {}))
+    if tier == "fast" and (not OLLAMA_FAST_MODEL or "fast" in _disabled_tiers):
+        tier = "main"
+    model = OLLAMA_FAST_MODEL if tier == "fast" else OLLAMA_MODEL
+    options = {**OLLAMA_OPTIONS, **overrides}
+    if task == "answer":
+        cap = _expected_answer_tokens(text)
+        if cap is not None and int(options.get("num_predict") or cap) > cap:
+            options["num_predict"] = cap
+    return tier, model, options
+
+
+def _disable_tier(tier: str, model: str, exc: Exception) -> None:
+    _disabled_tiers.add(tier)
+    print(f"[Ollama] Modelo '{model}' no disponible ({exc}); el nivel '{tier}' usará {OLLAMA_MODEL}")
+
+
+_ollama_pool = OllamaPool(OLLAMA_HOSTS)
+
+
+def _record_ollama_timing(kind: str, wall_ms: float, resp) -> None:
+    """Separa en /metrics las peticiones en frío (Ollama tuvo que cargar el
+    modelo, según load_duration) de las que lo encontraron residente."""
+    try:
+        load_ms = float((resp or {}).get("load_duration") or 0) / 1e6
+    except Exception:
+        load_ms = 0.0
+    state = "cold" if load_ms >= OLLAMA_COLD_LOAD_MS else "warm"
+    _metrics.observe(f"ollama.{kind}_{state}_ms", wall_ms)
+    if state == "cold":
+        _metrics.observe("ollama.load_ms", load_ms)
+        print(f"[Ollama] Petición en frío: {load_ms:.0f} ms cargando {OLLAMA_MODEL}")
+
+
+def _record_prompt_eval(kind: str, resp) -> None:
+    """Prefill de la petición: cuántos tokens del prompt tuvo que evaluar el
+    servidor (los del prefijo en caché no cuentan) y cuánto tardó."""
     try:
-        if OLLAMA_HOST:
-            client = ollama.Client(host=OLLAMA_HOST)
-            resp = client.chat(model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS)
-        else:
-            resp = ollama.chat(model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS)
+        count = int((resp or {}).get("prompt_eval_count") or 0)
+        ms = float((resp or {}).get("prompt_eval_duration") or 0) / 1e6
+    except Exception:
+        return
+    if count <= 0 and ms <= 0:
+        return
+    _metrics.observe(f"ollama.{kind}_prompt_eval_ms", ms)
+    _metrics.incr(f"ollama.{kind}_prompt_eval_tokens", count)
+    print(f"[Ollama] Prefill ({kind}): {count} tokens en {ms:.0f} ms")
+
+
+def warm_up_ollama() -> None:
+    """Carga el modelo en los servidores en segundo plano (chat sin mensajes) y
+    lo deja residente OLLAMA_KEEP_ALIVE, para que el primer turno no pague la
+    carga. Se precargan todos para que un failover también encuentre el modelo."""
+    def run(backend: OllamaBackend) -> None:
+        if not _ollama_pool.check(backend):
+            print(f"[Ollama] {backend.host} no disponible o sin {OLLAMA_MODEL}; no se precarga")
+            return
+        t0 = time.perf_counter()
+        try:
+            resp = _ollama_pool.warm_up(backend)
+            ms = 1000.0 * (time.perf_counter() - t0)
+            _record_ollama_timing("warmup", ms, resp)
+            print(f"[Ollama] {OLLAMA_MODEL} precargado en {backend.host} en {ms:.0f} ms (keep_alive={OLLAMA_KEEP_ALIVE})")
+        except Exception as exc:
+            print(f"[Ollama] No se pudo precargar {OLLAMA_MODEL} en {backend.host}: {exc}")
+        # Modelo pequeño de las tareas cortas
+        if OLLAMA_FAST_MODEL and OLLAMA_FAST_MODEL != OLLAMA_MODEL and "fast" not in _disabled_tiers:
+            try:
+                _ollama_pool.warm_up(backend, OLLAMA_FAST_MODEL)
+                print(f"[Ollama] {OLLAMA_FAST_MODEL} precargado en {backend.host}")
+            except ollama.ResponseError as exc:
+                if getattr(exc, "status_code", 0) == 404:
+                    _disable_tier("fast", OLLAMA_FAST_MODEL, exc)
+            except Exception as exc:
+                print(f"[Ollama] No se pudo precargar {OLLAMA_FAST_MODEL} en {backend.host}: {exc}")
+
+    for backend in _ollama_pool.backends:
+        threading.Thread(target=run, args=(backend,), daemon=True).start()
+
+
+class FailedReply(str):
+    """Aviso o error que se locuta como respuesta pero no lo es: no entra en la
+    conversación ni sirve como resumen."""
+
+
+def _ollama_chat(messages: list, task: str = "answer", options: Optional[dict] = None) -> str:
+    """Llama a Ollama de forma no streaming y devuelve el texto completo.
+    'task' elige modelo y opciones (ver TASK_PROFILES); 'options' las ajusta."""
+    text = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    tier, model, tier_options = select_model(task, text)
+    options = {**tier_options, **(options or {})}
+    try:
+        t0 = time.perf_counter()
+        try:
+            resp = _ollama_pool.chat(messages, options, model)
+        except ollama.ResponseError as exc:
+            if tier == "main" or getattr(exc, "status_code", 0) != 404:
+                raise
+            _disable_tier(tier, model, exc)
+            tier, model = "main", OLLAMA_MODEL
+            resp = _ollama_pool.chat(messages, options, model)
+        _metrics.observe(f"tier.{tier}.{task}_ms", 1000.0 * (time.perf_counter() - t0))
+    except (DeadlineExceeded, BackendUnavailable) as exc:
+        # Quien llama tiene su propia alternativa local (heurística, hora sin resumir...)
+        print(f"[Ollama] Sin respuesta: {exc}")
+        return ""
+    except Exception as exc:
+        return FailedReply(f"Error consultando el modelo: {exc}")
+    try:
+        _record_ollama_timing("chat", 1000.0 * (time.perf_counter() - t0), resp)
+        _record_prompt_eval("chat", resp)
         out = (resp or {}).get("message", {}).get("content", "")
         return (out or "").strip()
     except Exception as exc:
-        return f"Error consultando el modelo: {exc}"
+        return FailedReply(f"Error consultando el modelo: {exc}")
+
+
+def _normalize_transcript(text: str) -> str:
+    return re.sub(r"\s+", " ", (text or "").lower()).strip()
+
+
+class SpeculativeIntent:
+    """Clasificación de intención lanzada antes de que termine el comando.
+
+    Cuando el parcial de Vosk lleva SPECULATIVE_STABLE_MS sin cambiar, se
+    clasifica en segundo plano ese texto y, si no es una consulta nativa, se
+    precarga el prompt de respuesta en Ollama (num_predict=1) para que la
+    petición real reutilice su caché. La clasificación se publica en cuanto
+    está lista; la precarga sigue en segundo plano y nadie la espera. Al
+    llegar el texto final: si coincide se usa el resultado (acierto); si no,
+    se descarta (Ollama no permite
+    abortar una petición en curso, solo se ignora). Mientras una especulación
+    descartada siga ocupando el único hilo no se lanza otra: quedaría en cola
+    detrás de trabajo inútil y sumaría latencia en vez de ahorrarla. Aciertos
+    y latencia ahorrada quedan en /metrics (speculation.*).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="especulacion")
+        self._future: Optional[Future] = None  # trabajo completo (clasificación + precarga)
+        self._classified: Optional[Future] = None  # solo la clasificación
+        self._stale: Optional[Future] = None  # descartada pero aún en ejecución
+        self._text = ""
+        self._started = 0.0
+
+    def reset(self) -> None:
+        with self._lock:
+            self._discard()
+
+    def _discard(self) -> None:
+        if self._future is not None:
+            if not self._future.cancel():
+                _metrics.incr("speculation.wasted")
+                self._stale = self._future
+        self._future = None
+        self._classified = None
+        self._text = ""
+
+    def observe(self, hypothesis: str, stable_ms: float) -> None:
+        """Llamado por cada bloque con la hipótesis actual y su estabilidad."""
+        if not SPECULATIVE or stable_ms < SPECULATIVE_STABLE_MS:
+            return
+        text = _normalize_transcript(hypothesis)
+        if not text or "[unk]" in text or match_command_phrase(text) is not None:
+            return
+        with self._lock:
+            if text == self._text:
+                return
+            self._discard()
+            if self._stale is not None and not self._stale.done():
+                _metrics.incr("speculation.skipped_busy")
+                return
+            self._stale = None
+            self._text = text
+            self._started = time.perf_counter()
+            self._classified = Future()
+            self._future = self._executor.submit(self._run, text, self._classified)
+            _metrics.incr("speculation.started")
+
+    @staticmethod
+    def _run(text: str, classified: Future) -> None:
+        try:
+            result = classify_intent(text)
+        except Exception as exc:
+            classified.set_exception(exc)
+            return
+        classified.set_result((result, time.perf_counter()))
+        if result[0] == "other" and SPECULATIVE_PREFILL:
+            _ollama_chat(build_ollama_messages(text), task="answer", options={"num_predict": 1})
+
+    def resolve(self, final_text: str) -> Optional[Tuple[IntentType, dict]]:
+        """Resultado especulado si coincide con el texto final; None si no hay o no coincide."""
+        with self._lock:
+            future, text, started = self._classified, self._text, self._started
+            if future is None:
+                return None
+            if text != _normalize_transcript(final_text):
+                _metrics.incr("speculation.misses")
+                self._discard()
+                return None
+            # La precarga que quede sigue en el hilo; si aún corre, la próxima
+            # especulación no se encola detrás
+            self._stale = self._future
+            self._future = None
+            self._classified = None
+            self._text = ""
+        now = time.perf_counter()
+        try:
+            result, done_at = future.result(timeout=budget_timeout(OLLAMA_STALL_SECS))
+        except Exception as exc:
+            print(f"[Especulación] Error: {exc}")
+            return None
+        # Clasificación hecha antes de tener el texto final = latencia ahorrada
+        # (la precarga no cuenta: no se espera)
+        saved_ms = 1000.0 * max(0.0, min(done_at, now) - started)
+        _metrics.incr("speculation.hits")
+        _metrics.observe("speculation.saved_ms", saved_ms)
+        print(f"[Especulación] Acierto: '{text}' → {result[0]} (ahorro {saved_ms:.0f} ms)")
+        return result
+
+
+_speculation = SpeculativeIntent()
 
 
 def _summarize_weather_json(json_payload: dict, location_label: str) -> str:
@@ -238,7 +1249,7 @@ def _summarize_weather_json(json_payload: dict, location_label: str) -> str:
         f"Ubicación: {location_label}. JSON:\n" + json.dumps(json_payload, ensure_ascii=False)
     )
     messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
-    return _ollama_chat(messages)
+    return _ollama_chat(messages, task="weather_summary")
 
 
 def _summarize_time_json(json_payload: dict) -> str:
@@ -249,7 +1260,10 @@ def _summarize_time_json(json_payload: dict) -> str:
     )
     user = "Resume brevemente estos datos de hora local en una frase: " + json.dumps(json_payload, ensure_ascii=False)
     messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
-    return _ollama_chat(messages)
+    return _ollama_chat(messages, task="time_summary")
+
+
+_weather_breaker = CircuitBreaker("openweather")
 
 
 def _fetch_openweather(cfg: dict, when: str = "now") -> Tuple[Optional[dict], Optional[str]]:
@@ -270,15 +1284,46 @@ def _fetch_openweather(cfg: dict, when: str = "now") -> Tuple[Optional[dict], Op
         location_label = city
     else:
         return None, "Falta ubicación (ciudad o lat/lon). Configúrala en la interfaz web."
+    if not _weather_breaker.acquire():
+        return None, CANNED_PHRASES["weather_down"]
     try:
-        r = requests.get(url, params=params, timeout=10)
+        r = requests.get(url, params=params, timeout=budget_timeout(10))
         if r.status_code != 200:
+            # 4xx = configuración (API key, ciudad): el servicio responde
+            if r.status_code >= 500:
+                _weather_breaker.failure()
+            else:
+                _weather_breaker.success()
             return None, f"OpenWeather devolvió {r.status_code}: {r.text[:200]}"
         data = r.json()
+        _weather_breaker.success()
         data["_location_label"] = location_label
         return data, None
     except Exception as exc:
+        _weather_breaker.failure()
         return None, f"Error consultando OpenWeather: {exc}"
+    finally:
+        _weather_breaker.release()
+        budget = current_budget()
+        if budget is not None:
+            budget.stage("tool")
+
+
+def _local_weather_summary(data: dict, location_label: str) -> str:
+    """Resumen sin IA a partir del JSON de OpenWeather (si la IA no responde a tiempo)."""
+    try:
+        main = data.get("main") or {}
+        desc = ((data.get("weather") or [{}])[0].get("description") or "").strip()
+        parts = [f"En {location_label}" if location_label else "Ahora"]
+        if desc:
+            parts.append(desc)
+        if main.get("temp") is not None:
+            parts.append(f"{round(float(main['temp']))} grados")
+        if main.get("feels_like") is not None:
+            parts.append(f"sensación de {round(float(main['feels_like']))}")
+        return ", ".join(parts) + "."
+    except Exception:
+        return ""
 
 
 def handle_weather_command(original_text: str, when: Optional[str] = None) -> str:
@@ -287,11 +1332,13 @@ def handle_weather_command(original_text: str, when: Optional[str] = None) -> st
         when = detect_intent(original_text)[1].get("when", "now")
     data, err = _fetch_openweather(cfg, when=when)
     if err:
-        return err
+        return FailedReply(err)
     assert data is not None
     location_label = data.pop("_location_label", cfg.get("city") or "")
     summary = _summarize_weather_json(data, location_label or "")
-    return summary or "No pude generar el resumen del clima."
+    if isinstance(summary, FailedReply):
+        summary = ""
+    return summary or _local_weather_summary(data, location_label or "") or FailedReply("No pude generar el resumen del clima.")
 
 
 def handle_time_command() -> str:
@@ -317,6 +1364,8 @@ def handle_time_command() -> str:
         "utc_offset": offset_str,
     }
     summary = _summarize_time_json(payload)
+    if isinstance(summary, FailedReply):
+        summary = ""
     return summary or f"Son las {payload['time_24h']} ({payload['timezone']})."
 
 
@@ -406,6 +1455,10 @@ def _create_flask_app() -> Flask:
     def cfg_index():
         return render_template_string(_TEMPLATE, cfg=load_config())
 
+    @app.get("/metrics")
+    def cfg_metrics():
+        return jsonify(_metrics.snapshot())
+
     @app.post("/save")
     def cfg_save():
         cfg = load_config()
@@ -506,23 +1559,269 @@ def ensure_paths() -> None:
         raise FileNotFoundError(
             f"No se encontraron los archivos de voz de Piper en {os.path.dirname(PIPER_MODEL)}"
         )
-    # Detectar sample rate real del dispositivo de entrada
-    global SAMPLE_RATE
-    try:
-        device_info = sd.query_devices(sd.default.device, "input")
-        SAMPLE_RATE = int(device_info.get("default_samplerate", SAMPLE_RATE))
-    except Exception:
-        pass
+    # Detectar sample rate nativo del dispositivo de entrada. Los reconocedores
+    # siguen a SAMPLE_RATE (16 kHz): la captura remuestrea en proceso.
+    global CAPTURE_RATE
+    if not os.getenv("CAPTURE_RATE"):
+        try:
+            device_info = sd.query_devices(sd.default.device, "input")
+            CAPTURE_RATE = int(device_info.get("default_samplerate", CAPTURE_RATE))
+        except Exception:
+            pass
     global _vosk_model
     if _vosk_model is None:
+        t0 = time.perf_counter()
         _vosk_model = vosk.Model(VOSK_MODEL_DIR)
+        _metrics.observe("startup.vosk_model_ms", 1000.0 * (time.perf_counter() - t0))
 
-def _rms_int16(audio: np.ndarray) -> float:
-    if audio.size == 0:
-        return 0.0
-    if audio.ndim > 1:
-        audio = audio.mean(axis=1)
-    return float(np.sqrt(np.mean(audio.astype(np.float32) ** 2)))
+class PolyphaseResampler:
+    """Remuestreador polifásico vectorizado para PCM16 mono en streaming.
+
+    Convierte in_rate → out_rate con un filtro FIR (sinc con ventana de Kaiser)
+    descompuesto en fases. Para un tamaño de bloque fijo, los índices y
+    coeficientes de cada muestra de salida se precalculan, así que cada bloque
+    es un gather + multiplicación + suma sobre buffers preasignados, sin
+    reservar memoria. process() devuelve una vista del buffer interno: hay que
+    consumirla (o copiarla) antes de la siguiente llamada.
+    """
+
+    def __init__(self, in_rate: int, out_rate: int, block_in: int, taps_per_phase: int = 24) -> None:
+        g = math.gcd(int(in_rate), int(out_rate))
+        self.in_rate = int(in_rate)
+        self.out_rate = int(out_rate)
+        self.up = self.out_rate // g
+        self.down = self.in_rate // g
+        self.taps = int(taps_per_phase)
+        n = self.taps * self.up
+        # Paso bajo al 90% del Nyquist más restrictivo, en la frecuencia sobremuestreada
+        cutoff = 0.9 * 0.5 / max(self.up, self.down)
+        m = np.arange(n) - (n - 1) / 2.0
+        h = 2.0 * cutoff * np.sinc(2.0 * cutoff * m) * np.kaiser(n, 6.0)
+        # Ganancia 'up' en continua: cada fase suma ~1
+        self._h = (h / h.sum() * self.up).astype(np.float32)
+        self._configure(int(block_in))
+
+    @staticmethod
+    def block_multiple(in_rate: int, out_rate: int) -> int:
+        """Múltiplo de entrada que produce un número entero de muestras de salida."""
+        return int(in_rate) // math.gcd(int(in_rate), int(out_rate))
+
+    def _configure(self, block_in: int) -> None:
+        if block_in % self.down:
+            raise ValueError(f"El bloque de {block_in} muestras no es múltiplo de {self.down}")
+        self.block_in = block_in
+        self.block_out = block_in * self.up // self.down
+        t = np.arange(self.block_out) * self.down
+        phase = t % self.up
+        k = np.arange(self.taps)
+        self._hist = self.taps
+        self._idx = (self._hist + (t // self.up))[:, None] - k[None, :]
+        self._coef = self._h[phase[:, None] + k[None, :] * self.up]
+        self._buf = np.zeros(self._hist + block_in, dtype=np.float32)
+        self._work = np.empty(self._idx.shape, dtype=np.float32)
+        self._acc = np.empty(self.block_out, dtype=np.float32)
+        self._out = np.empty(self.block_out, dtype=np.int16)
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        if audio.size != self.block_in:
+            # PortAudio entrega bloques fijos; esto solo pasa si cambia la configuración
+            self._configure(int(audio.size))
+        np.copyto(self._buf[:self._hist], self._buf[self.block_in:self.block_in + self._hist])
+        np.copyto(self._buf[self._hist:], audio, casting="unsafe")
+        np.take(self._buf, self._idx, out=self._work)
+        np.multiply(self._work, self._coef, out=self._work)
+        np.sum(self._work, axis=1, out=self._acc)
+        np.rint(self._acc, out=self._acc)
+        np.clip(self._acc, -32768, 32767, out=self._acc)
+        np.copyto(self._out, self._acc, casting="unsafe")
+        return self._out
+
+
+def resample_int16(audio: np.ndarray, in_rate: int, out_rate: int) -> np.ndarray:
+    """Remuestrea un clip completo (p.ej. un WAV) con PolyphaseResampler."""
+    if int(in_rate) == int(out_rate) or audio.size == 0:
+        return audio
+    mult = PolyphaseResampler.block_multiple(in_rate, out_rate)
+    block = mult * max(1, (in_rate // 10) // mult)
+    rs = PolyphaseResampler(in_rate, out_rate, block)
+    padded = np.zeros(-(-audio.size // block) * block, dtype=np.int16)
+    padded[:audio.size] = audio
+    out = [rs.process(padded[i:i + block]).copy() for i in range(0, padded.size, block)]
+    return np.concatenate(out)[:audio.size * rs.up // rs.down]
+
+
+class FrameVAD:
+    """Detector de actividad de voz por tramas, vectorizado con NumPy.
+
+    Parte cada bloque en tramas de VAD_FRAME_MS y, en una sola pasada, calcula
+    energía (dB) y tasa de cruces por cero de todas ellas. La probabilidad de
+    voz sale de la relación señal/ruido frente a un suelo de ruido adaptativo,
+    penalizada cuando la ZCR es propia de zumbidos o siseos. La decisión final
+    aplica histéresis (VAD_ON/VAD_OFF) para no trocear palabras. Es lo bastante
+    barato para ejecutarse dentro del callback de captura.
+    """
+
+    def __init__(self, samplerate: int, frame_ms: int = VAD_FRAME_MS) -> None:
+        self.samplerate = int(samplerate)
+        self.frame_ms = max(10, min(30, int(frame_ms)))
+        self.frame_len = max(1, self.samplerate * self.frame_ms // 1000)
+        self.noise_db: Optional[float] = None
+        self.speaking = False  # estado de la histéresis tras la última trama
+        self._carry = np.zeros(0, dtype=np.int16)
+
+    def _features(self, frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        x = frames.astype(np.float32)
+        energy_db = 10.0 * np.log10(np.mean(x * x, axis=1) + 1.0)
+        signs = np.signbit(x)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / float(self.frame_len)
+        return energy_db, zcr
+
+    def _probabilities(self, energy_db: np.ndarray, zcr: np.ndarray) -> np.ndarray:
+        noise_db = self.noise_db if self.noise_db is not None else float(np.min(energy_db))
+        snr = energy_db - noise_db
+        p = 1.0 / (1.0 + np.exp(-(snr - VAD_SNR_DB) / 3.0))
+        # Voz típica: ZCR entre ~0.02 y ~0.4. Fuera de ahí, zumbido o siseo
+        zcr_w = np.clip(1.0 - np.maximum(zcr - 0.4, 0.0) / 0.3, 0.5, 1.0)
+        zcr_w = zcr_w * np.clip(zcr / 0.02, 0.5, 1.0)
+        return p * zcr_w
+
+    def _hysteresis(self, probs: np.ndarray, start: bool) -> np.ndarray:
+        # -1 = zona intermedia: hereda la última decisión firme (forward fill vectorizado)
+        state = np.full(probs.size, -1, dtype=np.int8)
+        state[probs >= VAD_ON] = 1
+        state[probs <= VAD_OFF] = 0
+        idx = np.where(state >= 0, np.arange(probs.size), -1)
+        np.maximum.accumulate(idx, out=idx)
+        return np.where(idx >= 0, state[np.maximum(idx, 0)] == 1, start)
+
+    def _track_noise(self, energy_db: np.ndarray, probs: np.ndarray) -> None:
+        quiet = energy_db[probs < 0.5]
+        if quiet.size == 0:
+            return
+        level = float(np.percentile(quiet, 20))
+        if self.noise_db is None:
+            self.noise_db = level
+        elif level < self.noise_db:
+            # Bajar rápido (el ruido desaparece), subir despacio (evita aprender la voz)
+            self.noise_db += 0.5 * (level - self.noise_db)
+        else:
+            self.noise_db += 0.05 * (level - self.noise_db)
+
+    def process(self, audio: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Analiza un bloque int16 y devuelve (probabilidades, decisiones) por trama.
+
+        Las muestras que no completan una trama se guardan para el siguiente
+        bloque, así que el número de tramas puede variar en ±1 entre bloques.
+        """
+        if self._carry.size:
+            audio = np.concatenate((self._carry, audio))
+        n = audio.size // self.frame_len
+        self._carry = audio[n * self.frame_len:].copy()
+        if n == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=bool)
+        energy_db, zcr = self._features(audio[:n * self.frame_len].reshape(n, self.frame_len))
+        probs = self._probabilities(energy_db, zcr)
+        flags = self._hysteresis(probs, self.speaking)
+        self.speaking = bool(flags[-1])
+        self._track_noise(energy_db, probs)
+        return probs.astype(np.float32), flags
+
+    def analyze(self, audio: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Como process() pero sin tocar el estado (para audio ya pasado, p.ej. pre-roll)."""
+        n = audio.size // self.frame_len
+        if n == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=bool)
+        energy_db, zcr = self._features(audio[:n * self.frame_len].reshape(n, self.frame_len))
+        probs = self._probabilities(energy_db, zcr)
+        return probs.astype(np.float32), self._hysteresis(probs, False)
+
+
+class AudioBlock(NamedTuple):
+    """Bloque entregado a los consumidores de la captura.
+
+    'data' suele ser un memoryview sobre un buffer preasignado de la captura:
+    solo es válido hasta que el consumidor lee unos cuantos bloques más.
+    """
+    data: memoryview  # PCM16 mono (bytes-like, len() en bytes)
+    probs: np.ndarray  # probabilidad de voz por trama de VAD
+    speech: np.ndarray  # decisión de voz por trama (con histéresis)
+
+
+class Endpointer:
+    """Decide cuándo ha terminado un comando hablado.
+
+    Combina tres pistas, todas medidas con el reloj del audio (muestras) y no
+    con time.time():
+      - las decisiones por trama del VAD (suelo de ruido adaptativo),
+      - los límites de frase de Vosk (AcceptWaveform() devolvió True),
+      - la estabilidad del parcial (la hipótesis no cambia).
+    Si la frase parece completa basta ENDPOINT_FAST_MS de silencio final; si no,
+    se espera ENDPOINT_SILENCE_MS. El silencio final se mide con resolución de
+    trama de VAD, no de bloque.
+    """
+
+    def __init__(self, samplerate: int = SAMPLE_RATE, frame_ms: int = VAD_FRAME_MS) -> None:
+        self.samplerate = int(samplerate)
+        self.frame_ms = float(frame_ms)
+        self.reset()
+
+    def reset(self, ignore_speech_ms: float = 0.0) -> None:
+        """Empieza un comando nuevo. El VAD de los primeros 'ignore_speech_ms'
+        no cuenta como voz (p.ej. el beep de inicio captado por el micro)."""
+        self.ignore_speech_ms = float(ignore_speech_ms)
+        self.elapsed_ms = 0.0
+        self.speech_ms = 0.0
+        self.trailing_silence_ms = 0.0
+        self.stable_ms = 0.0
+        self.final_boundary = False
+        self._hypothesis = ""
+
+    def update(self, block: AudioBlock, final: bool = False, hypothesis: str = "") -> Optional[str]:
+        """Procesa un bloque y devuelve el motivo de fin, o None si hay que seguir."""
+        dur_ms = 1000.0 * (len(block.data) // 2) / self.samplerate
+        speech = block.speech
+        if speech.size and self.elapsed_ms < self.ignore_speech_ms:
+            # Tramas que caen dentro del beep: el audio sigue al decodificador,
+            # pero no cuentan como voz ni quitan la espera de ENDPOINT_NO_SPEECH_MS
+            masked = int(np.ceil((self.ignore_speech_ms - self.elapsed_ms) / self.frame_ms))
+            speech = speech.copy()
+            speech[:masked] = False
+        self.elapsed_ms += dur_ms
+        if speech.size and speech.any():
+            voiced = np.flatnonzero(speech)
+            self.speech_ms += voiced.size * self.frame_ms
+            self.trailing_silence_ms = (speech.size - 1 - int(voiced[-1])) * self.frame_ms
+            self.final_boundary = False
+        else:
+            self.trailing_silence_ms += speech.size * self.frame_ms
+        if final:
+            self.final_boundary = True
+        if hypothesis and hypothesis == self._hypothesis:
+            self.stable_ms += dur_ms
+        else:
+            self._hypothesis = hypothesis
+            self.stable_ms = 0.0
+
+        if self.elapsed_ms >= MAX_COMMAND_SECS * 1000:
+            return "max"
+        if self.speech_ms == 0.0:
+            return "no_speech" if self.elapsed_ms >= ENDPOINT_NO_SPEECH_MS else None
+        complete = self.final_boundary or (bool(self._hypothesis) and self.stable_ms >= ENDPOINT_STABLE_MS)
+        if complete and self.trailing_silence_ms >= ENDPOINT_FAST_MS:
+            return "fast"
+        if self.trailing_silence_ms >= ENDPOINT_SILENCE_MS:
+            return "silence"
+        return None
+
+
+_endpointer: Optional[Endpointer] = None
+
+
+def get_endpointer() -> Endpointer:
+    global _endpointer
+    if _endpointer is None or _endpointer.samplerate != SAMPLE_RATE:
+        _endpointer = Endpointer(SAMPLE_RATE, get_capture_frame_ms())
+    return _endpointer
 
 
 def _aplay_tuning_args() -> list:
@@ -547,320 +1846,282 @@ def _aplay_tuning_args() -> list:
     return args
 
 
-def speak(text: str) -> None:
-    if not text:
-        return
+class TTSEngine:
+    """Motor de TTS único para todas las respuestas (IA, clima, hora, avisos).
 
-    print(f"[TTS] Intentando sintetizar: '{text[:100]}...'")
-    _discover_and_set_piper_voice()  # Asegurar que la voz esté configurada
+    Carga PiperVoice una sola vez y sintetiza en proceso, entregando PCM16
+    mono por fragmentos para que suene mientras se genera. Cada texto se
+    sintetiza una única vez: si falla la salida de audio, se reintenta solo
+    la reproducción del PCM ya generado por otra ruta.
+    """
 
-    # Validar ficheros de voz Piper
-    if not _validate_piper_files():
-        print("[TTS] Archivos de voz Piper ausentes o corruptos. Omite TTS.")
-        return
-    # 1) Streaming con CLI de Piper → aplay (empieza a sonar de inmediato)
-    try:
-        cmd = ["piper", "-m", PIPER_MODEL, "-c", PIPER_CONFIG, "-f", "-"]
-        print(f"[TTS] Lanzando Piper CLI streaming: {' '.join(cmd)}")
-        proc_tts = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=False,
-            bufsize=0,
-        )
-        assert proc_tts.stdin is not None and proc_tts.stdout is not None
-
-        def build_aplay_cmd(use_plug: bool) -> list:
-            base = ["aplay", "-q", "-t", "wav"] + _aplay_tuning_args() + ["-"]
-            aplay_dev = os.getenv("APLAY_DEVICE")
-            if aplay_dev:
-                dev = aplay_dev
-                if use_plug and aplay_dev.startswith("hw:"):
-                    dev = "hw:" + aplay_dev.split(":", 1)[1]
-                return ["aplay", "-q", "-D", dev, "-t", "wav"] + _aplay_tuning_args() + ["-"]
-            return base
-
-        # Si es dispositivo hw:* y tenemos sox, insertar conversión a 48k/16-bit/estéreo
-        aplay_dev_env = os.getenv("APLAY_DEVICE", "")
-        have_sox = shutil.which("sox") is not None
-        if aplay_dev_env.startswith("hw:") and have_sox:
-            sox_cmd = [
-                "sox",
-                "-t", "wav", "-",  # entrada WAV desde Piper
-                "-r", "48000",
-                "-b", "16",
-                "-c", "2",
-                "-t", "wav", "-",  # salida WAV hacia aplay
-            ]
-            print(f"[TTS] Insertando conversión con sox: {' '.join(sox_cmd)}")
-            proc_sox = subprocess.Popen(
-                sox_cmd,
-                stdin=proc_tts.stdout,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            # aplay leerá desde la salida de sox
-            aplay_cmd = build_aplay_cmd(use_plug=False)
-            print(f"[TTS] Encadenando aplay streaming: {' '.join(aplay_cmd)}")
-            proc_play = subprocess.Popen(
-                aplay_cmd,
-                stdin=proc_sox.stdout,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-            )
-        else:
-            # Intento 1: usar dispositivo tal cual (hw/plughw/default)
-            aplay_cmd = build_aplay_cmd(use_plug=False)
-            print(f"[TTS] Encadenando aplay streaming: {' '.join(aplay_cmd)}")
-            proc_play = subprocess.Popen(
-                aplay_cmd,
-                stdin=proc_tts.stdout,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-            )
-        # Escribir el texto a Piper para que empiece a generar
-        proc_tts.stdin.write((text.strip() + "\n").encode("utf-8"))
-        proc_tts.stdin.flush()
-        proc_tts.stdin.close()
-        # No cerrar proc_tts.stdout aquí; es la tubería hacia aplay
-
-        ret_aplay = proc_play.wait()
-        if ret_aplay != 0:
-            err_play1 = b""
-            try:
-                err_play1 = proc_play.stderr.read() or b""
-            except Exception:
-                pass
-            # Terminar Piper para evitar BrokenPipe masivo
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.parallel = False  # ¿se pueden sintetizar varias frases a la vez con la misma voz?
+
+    def voice(self):
+        global _piper_voice
+        with self._lock:
+            if _piper_voice is None:
+                _discover_and_set_piper_voice()
+                t0 = time.perf_counter()
+                _piper_voice = self._load()
+                self._configure(_piper_voice)
+                _metrics.observe("startup.tts_voice_ms", 1000.0 * (time.perf_counter() - t0))
+                print(f"[TTS] Voz cargada: {PIPER_MODEL} ({_piper_voice.config.sample_rate} Hz)")
+            return _piper_voice
+
+    @staticmethod
+    def _load():
+        """Carga la voz con una sola sesión de onnxruntime, ya limitada a
+        TTS_THREADS. PiperVoice.load() no admite SessionOptions, así que la voz
+        se monta sobre nuestra sesión; si la versión de piper no lo permite, se
+        carga con sus opciones por defecto."""
+        from piper.voice import PiperVoice  # type: ignore
+        workers = max(1, TTS_LOOKAHEAD)
+        try:
+            import onnxruntime  # type: ignore
+            from piper.config import PiperConfig  # type: ignore
+            opts = onnxruntime.SessionOptions()
+            # intra_op incluye el hilo que llama: con 'workers' síntesis a la vez el total es TTS_THREADS
+            opts.intra_op_num_threads = max(1, TTS_THREADS - workers + 1)
+            opts.inter_op_num_threads = 1
+            with open(PIPER_CONFIG or f"{PIPER_MODEL}.json", "r", encoding="utf-8") as fh:
+                config = PiperConfig.from_dict(json.load(fh))
+            session = onnxruntime.InferenceSession(
+                PIPER_MODEL, sess_options=opts, providers=["CPUExecutionProvider"])
+            voice = PiperVoice(config=config, session=session)
+            print(f"[TTS] onnxruntime: {opts.intra_op_num_threads} hilo(s) por síntesis, hasta {workers} a la vez")
+            return voice
+        except Exception as exc:
+            print(f"[TTS] No se pudo ajustar los hilos de onnxruntime: {exc}")
+        return PiperVoice.load(PIPER_MODEL, PIPER_CONFIG)
+
+    def _configure(self, voice) -> None:
+        """Prepara la voz para sintetizar varias frases a la vez (la inferencia
+        ONNX admite llamadas concurrentes; la fonemización con espeak no, así
+        que va con lock)."""
+        phonemize = getattr(voice, "phonemize", None)
+        if callable(phonemize):
+            lock = threading.Lock()
+
+            def locked_phonemize(*args, **kwargs):
+                with lock:
+                    return phonemize(*args, **kwargs)
+
+            voice.phonemize = locked_phonemize
+            self.parallel = True
+
+    @property
+    def sample_rate(self) -> int:
+        return int(self.voice().config.sample_rate)
+
+    @staticmethod
+    def _to_bytes(chunk) -> bytes:
+        """PCM16 de un fragmento de piper-tts (según versión: AudioChunk, bytes o array)."""
+        for attr in ("audio_int16_bytes", "pcm", "data"):
+            if hasattr(chunk, attr):
+                chunk = getattr(chunk, attr)
+                break
+        if chunk is None:
+            return b""
+        if isinstance(chunk, (bytes, bytearray)):
+            return bytes(chunk)
+        if hasattr(chunk, "astype"):
             try:
-                proc_tts.kill()
+                return chunk.astype("<i2").tobytes()
             except Exception:
                 pass
+        try:
+            return memoryview(chunk).tobytes()
+        except Exception:
+            return b""
 
-            # Reintentar con plughw si el dispositivo era hw
-            aplay_dev_env = os.getenv("APLAY_DEVICE", "")
-            # Intento alternativo: 'default' puro
-            if aplay_dev_env and aplay_dev_env != "default":
-                aplay_cmd_def = ["aplay", "-q", "-D", "default", "-t", "wav"] + _aplay_tuning_args() + ["-"]
-                print(f"[TTS] Reintentando con dispositivo 'default': {' '.join(aplay_cmd_def)}")
-                proc_tts = subprocess.Popen(
-                    cmd,
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=False,
-                    bufsize=0,
-                )
-                assert proc_tts.stdin is not None and proc_tts.stdout is not None
-                proc_play = subprocess.Popen(
-                    aplay_cmd_def,
-                    stdin=proc_tts.stdout,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE,
-                )
-                proc_tts.stdin.write((text.strip() + "\n").encode("utf-8"))
-                proc_tts.stdin.flush()
-                proc_tts.stdin.close()
-                ret_aplay2 = proc_play.wait()
-                if ret_aplay2 == 0:
-                    _ = proc_tts.wait(timeout=60)
-                    print("[TTS] Streaming Piper → aplay (default) finalizado correctamente")
-                    return
-                else:
-                    try:
-                        err_play_def = proc_play.stderr.read() or b""
-                        if err_play_def:
-                            print(f"[TTS] aplay (default) error: {err_play_def.decode(errors='ignore').strip()}")
-                    except Exception:
-                        pass
+    def synthesize(self, text: str):
+        """Genera PCM16 mono a sample_rate por fragmentos. Si la voz en proceso
+        no da audio, se intenta una vez con Piper CLI."""
+        produced = False
+        try:
+            for chunk in self.voice().synthesize(text):
+                data = self._to_bytes(chunk)
+                if data:
+                    produced = True
+                    yield data
+        except Exception as exc:
+            print(f"[TTS] Error sintetizando en proceso: {exc}")
+        if produced:
+            return
+        try:
+            proc = subprocess.run(
+                ["piper", "-m", PIPER_MODEL, "-c", PIPER_CONFIG, "-f", "-"],
+                input=(text.strip() + "\n").encode("utf-8"), capture_output=True, timeout=60,
+            )
+            if proc.stdout:
+                with wave.open(io.BytesIO(proc.stdout), "rb") as rdr:
+                    frames = rdr.readframes(rdr.getnframes())
+                if frames:
+                    print("[TTS] Audio generado con Piper CLI")
+                    yield frames
+        except Exception as exc:
+            print(f"[TTS] Piper CLI tampoco generó audio: {exc}")
+
+    def play(self, pcm: bytes) -> bool:
+        """Reproduce PCM ya sintetizado por la ruta de salida vigente."""
+        pipeline = open_output(self.sample_rate)
+        pipeline.write(pcm)
+        pipeline.close()
+        if not pipeline.ok and isinstance(pipeline, AudioPipeline):
+            _router.failed()  # la salida compartida ya lo notifica por su cuenta
+        return pipeline.ok
+
+    def speak(self, text: str) -> bool:
+        """Sintetiza y reproduce en streaming. False si no se pudo generar audio."""
+        t0 = time.perf_counter()
+        pcm = bytearray()
+        pipeline = None
+        for data in self.synthesize(text):
+            if pipeline is None:
+                _metrics.observe("tts.first_chunk_ms", 1000.0 * (time.perf_counter() - t0))
+                pipeline = open_output(self.sample_rate)
+            pcm.extend(data)
+            pipeline.write(data)
+        if pipeline is None:
+            return False
+        pipeline.close()
+        if pipeline.ok:
+            return True
+        # Mismo PCM por la ruta que salga del nuevo sondeo: nunca se vuelve a
+        # sintetizar por un fallo del dispositivo
+        if isinstance(pipeline, AudioPipeline):
+            _router.failed()
+        _metrics.incr("tts.output_retries")
+        return self.play(bytes(pcm))
 
-            if aplay_dev_env.startswith("hw:"):
-                aplay_cmd2 = build_aplay_cmd(use_plug=True)
-                print(f"[TTS] Reintentando con plughw: {' '.join(aplay_cmd2)}")
-                # Relanzar Piper para un stream nuevo
-                proc_tts = subprocess.Popen(
-                    cmd,
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=False,
-                    bufsize=0,
-                )
-                assert proc_tts.stdin is not None and proc_tts.stdout is not None
-                proc_play = subprocess.Popen(
-                    aplay_cmd2,
-                    stdin=proc_tts.stdout,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE,
-                )
-                proc_tts.stdin.write((text.strip() + "\n").encode("utf-8"))
-                proc_tts.stdin.flush()
-                proc_tts.stdin.close()
-                ret_aplay = proc_play.wait()
-                if ret_aplay == 0:
-                    # Esperar Piper a terminar y salir
-                    _ = proc_tts.wait(timeout=60)
-                    print("[TTS] Streaming Piper → aplay (plughw) finalizado correctamente")
-                    return
-                else:
-                    try:
-                        err_play2 = proc_play.stderr.read() or b""
-                    except Exception:
-                        err_play2 = b""
-                    print(f"[TTS] aplay (plughw) error: {err_play2.decode(errors='ignore').strip()}")
-                    # Si tenemos sox, último intento: Piper → sox (48k/2ch) → aplay hw
-                    if have_sox:
-                        sox_cmd = [
-                            "sox",
-                            "-t", "wav", "-",
-                            "-r", "48000",
-                            "-b", "16",
-                            "-c", "2",
-                            "-t", "wav", "-",
-                        ]
-                        print(f"[TTS] Intentando conversión final con sox hacia hw: {' '.join(sox_cmd)}")
-                        proc_tts = subprocess.Popen(
-                            cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=False,
-                            bufsize=0,
-                        )
-                        assert proc_tts.stdin is not None and proc_tts.stdout is not None
-                        proc_sox = subprocess.Popen(
-                            sox_cmd,
-                            stdin=proc_tts.stdout,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                        )
-                        aplay_cmd_hw = ["aplay", "-q", "-D", aplay_dev_env, "-t", "wav"] + _aplay_tuning_args() + ["-"]
-                        print(f"[TTS] Encadenando aplay (hw) tras sox: {' '.join(aplay_cmd_hw)}")
-                        proc_play = subprocess.Popen(
-                            aplay_cmd_hw,
-                            stdin=proc_sox.stdout,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.PIPE,
-                        )
-                        proc_tts.stdin.write((text.strip() + "\n").encode("utf-8"))
-                        proc_tts.stdin.flush()
-                        proc_tts.stdin.close()
-                        ret_aplay3 = proc_play.wait()
-                        if ret_aplay3 == 0:
-                            _ = proc_tts.wait(timeout=60)
-                            print("[TTS] Streaming Piper → sox → aplay (hw) finalizado correctamente")
-                            return
-                        else:
-                            try:
-                                err_ap3 = proc_play.stderr.read() or b""
-                                print(f"[TTS] aplay (hw tras sox) error: {err_ap3.decode(errors='ignore').strip()}")
-                            except Exception:
-                                pass
-
-            # Si sigue mal, leer stderr de Piper para registro
-            try:
-                err_tts = proc_tts.stderr.read() or b""
-                if err_play1:
-                    print(f"[TTS] aplay error: {err_play1.decode(errors='ignore').strip()}")
-                if err_tts:
-                    print(f"[TTS] Piper CLI stderr: {err_tts.decode(errors='ignore').strip()}")
-            except Exception:
-                pass
-            raise RuntimeError("aplay falló")
-        else:
-            # Esperar Piper a terminar y salir
-            ret_tts = proc_tts.wait(timeout=60)
-            if ret_tts == 0:
-                print("[TTS] Streaming Piper → aplay finalizado correctamente")
-                return
-            else:
-                try:
-                    err_tts = proc_tts.stderr.read() or b""
-                    if err_tts:
-                        print(f"[TTS] Piper CLI stderr: {err_tts.decode(errors='ignore').strip()}")
-                except Exception:
-                    pass
-                raise RuntimeError("Piper CLI falló")
-    except Exception as exc:
-        print(f"[TTS] Error en streaming Piper CLI: {exc}. Probando fallback Python...")
 
-    # 2) Fallback: piper-tts → WAV en memoria → aplay (mayor compatibilidad)
-    try:
-        print("[TTS] Inicializando fallback piper-tts (WAV en memoria)…")
-        global _piper_voice
-        if _piper_voice is None:
-            print(f"[TTS] Cargando modelo: {PIPER_MODEL}")
-            from piper.voice import PiperVoice  # type: ignore
-            _piper_voice = PiperVoice.load(PIPER_MODEL, PIPER_CONFIG)
-            print(f"[TTS] Modelo cargado correctamente, sample rate: {_piper_voice.config.sample_rate}")
-
-        pcm_iter = _piper_voice.synthesize(text)
-
-        # Construir WAV completo en memoria (PCM16 mono)
-        buf = io.BytesIO()
-        with wave.open(buf, "wb") as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)
-            wf.setframerate(_piper_voice.config.sample_rate)
-            for chunk in pcm_iter:
-                try:
-                    if hasattr(chunk, '__class__') and 'AudioChunk' in str(chunk.__class__):
-                        if hasattr(chunk, 'pcm'):
-                            if isinstance(chunk.pcm, (bytes, bytearray)):
-                                data = chunk.pcm
-                            elif hasattr(chunk.pcm, 'tobytes'):
-                                data = chunk.pcm.tobytes()
-                            else:
-                                data = bytes(chunk.pcm)
-                        elif hasattr(chunk, 'data'):
-                            data = chunk.data
-                        else:
-                            data = bytes(chunk)
-                    elif isinstance(chunk, (bytes, bytearray)):
-                        data = chunk
-                    elif hasattr(chunk, 'tobytes'):
-                        data = chunk.tobytes()
-                    else:
-                        data = bytes(chunk)
-                    if data:
-                        wf.writeframes(data)
-                except Exception:
-                    continue
-        wav_bytes = buf.getvalue()
+_tts = TTSEngine()
 
-        def build_wav_cmd(device: str | None) -> list:
-            if device is None:
-                return ["aplay", "-q", "-t", "wav"] + _aplay_tuning_args() + ["-"]
-            return ["aplay", "-q", "-D", device, "-t", "wav"] + _aplay_tuning_args() + ["-"]
 
-        # Intentar con APLAY_DEVICE
-        device_env = os.getenv("APLAY_DEVICE")
-        tried = []
-        for dev in [device_env, "default", None]:
-            if dev in tried:
-                continue
-            tried.append(dev)
-            cmd_ap = build_wav_cmd(dev)
-            try:
-                p = subprocess.Popen(cmd_ap, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                assert p.stdin is not None
-                p.stdin.write(wav_bytes)
-                p.stdin.close()
-                rc = p.wait()
-                if rc == 0:
-                    print("[TTS] Reproducción exitosa con WAV en memoria")
+class OrderedSynthesis:
+    """Síntesis de varias frases con anticipación y reproducción en orden.
+
+    Cada frase se encarga al pool en cuanto llega (hasta TTS_LOOKAHEAD a la
+    vez, o de una en una si la voz no admite concurrencia) y pcm() entrega el
+    audio estrictamente en el orden de las frases. El PCM sintetizado por
+    delante está acotado a TTS_READAHEAD_SECS: una frase que no es la que
+    suena espera a que haya hueco; la que suena nunca espera.
+    """
+
+    def __init__(self, engine: TTSEngine) -> None:
+        self.engine = engine
+        engine.voice()
+        workers = max(1, TTS_LOOKAHEAD) if engine.parallel else 1
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self._slots: "queue.Queue[Optional[queue.Queue]]" = queue.Queue()
+        self._cond = threading.Condition()
+        self._limit = max(1, int(TTS_READAHEAD_SECS * engine.sample_rate * 2))
+        self._buffered = 0
+        self._head = 0  # índice de la frase que se está reproduciendo
+        self._count = 0
+        self._cancelled = False
+
+    def submit(self, text: str) -> None:
+        slot: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        index = self._count
+        self._count += 1
+        self._slots.put(slot)
+        self._pool.submit(self._synthesize, index, text, slot)
+
+    def _synthesize(self, index: int, text: str, slot: "queue.Queue[Optional[bytes]]") -> None:
+        t0 = time.perf_counter()
+        total = 0
+        chunks = self.engine.synthesize(text)
+        try:
+            # Pedir el siguiente fragmento es lo que lo sintetiza: se mira
+            # '_cancelled' antes, no solo después
+            while not self._cancelled:
+                data = next(chunks, None)
+                if data is None:
+                    break
+                with self._cond:
+                    while not self._cancelled and index != self._head and self._buffered + len(data) > self._limit:
+                        self._cond.wait()
+                    if self._cancelled:
+                        return
+                    self._buffered += len(data)
+                slot.put(data)
+                total += len(data)
+        except Exception as exc:
+            print(f"[TTS-Pipeline] Error sintetizando la frase {index}: {exc}")
+        finally:
+            chunks.close()
+            slot.put(None)
+            _metrics.observe("tts.segment_synth_ms", 1000.0 * (time.perf_counter() - t0))
+            print(f"[TTS-Pipeline] Frase {index} sintetizada ({len(text)} chars, {total} bytes)")
+
+    def pcm(self):
+        """PCM de todas las frases, en orden, según va estando listo."""
+        try:
+            while True:
+                slot = self._slots.get()
+                if slot is None:
                     return
-                else:
-                    err = p.stderr.read() or b""
-                    print(f"[TTS] aplay (WAV) código {rc} con dispositivo {dev or 'por defecto'}: {err.decode(errors='ignore').strip()}")
-            except Exception as exc_:
-                print(f"[TTS] Error lanzando aplay (WAV) con dispositivo {dev or 'por defecto'}: {exc_}")
-    except Exception as exc:
-        print(f"[TTS] Error en fallback Piper-tts (streaming): {exc}")
+                waited_from = time.perf_counter()
+                first = True
+                while True:
+                    data = slot.get()
+                    if first and self._head > 0:
+                        # Tiempo que la frase anterior esperó a esta: el hueco entre frases
+                        _metrics.observe("tts.segment_gap_ms", 1000.0 * (time.perf_counter() - waited_from))
+                    first = False
+                    if data is None:
+                        break
+                    with self._cond:
+                        self._buffered -= len(data)
+                        self._cond.notify_all()
+                    if not self._cancelled:
+                        yield data
+                with self._cond:
+                    self._head += 1
+                    self._cond.notify_all()
+        finally:
+            self._pool.shutdown(wait=False)
 
-    # 3) Fallback opcional con espeak si está instalado y habilitado
+    def finish(self) -> None:
+        """No llegan más frases: pcm() termina tras la última."""
+        self._slots.put(None)
+
+    def cancel(self) -> None:
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+        self._slots.put(None)
+
+
+def speak(text: str) -> None:
+    if not text:
+        return
+    budget = current_budget()
+    if budget is not None:
+        budget.stage("respond")
+        budget.first_audio()
+    canned = _canned_pcm.get(text)
+    if canned:
+        print(f"[TTS] Aviso presintetizado: '{text[:100]}'")
+        _tts.play(canned)
+        return
+
+    print(f"[TTS] Sintetizando: '{text[:100]}...'")
+    # Validar ficheros de voz Piper
+    if _validate_piper_files():
+        try:
+            if _tts.speak(text.strip()):
+                return
+        except Exception as exc:
+            print(f"[TTS] Error en la síntesis: {exc}")
+    else:
+        print("[TTS] Archivos de voz Piper ausentes o corruptos.")
+
+    # Fallback opcional con espeak si está instalado y habilitado
     try:
         if os.getenv("USE_ESPEAK_FALLBACK", "0").lower() in {"1", "true", "yes"}:
             if shutil.which("espeak") is not None:
@@ -902,36 +2163,77 @@ def _generate_beep_wav_bytes(frequency_hz: int, duration_ms: int, volume: float
 
 
 def play_earcon(kind: str) -> None:
-    try:
-        if kind == "start_listen":
-            wav_bytes = _generate_beep_wav_bytes(1200, 250, volume=0.99)
-        elif kind == "end_listen":
-            wav_bytes = _generate_beep_wav_bytes(1200, 180, volume=0.99)
-        elif kind == "startup":
-            wav_bytes = _generate_beep_wav_bytes(800, 300, volume=0.99)
-        else:
-            wav_bytes = _generate_beep_wav_bytes(1200, 200, volume=0.55)
+    if kind == "start_listen":
+        wav_bytes = _generate_beep_wav_bytes(1200, 250, volume=0.99)
+    elif kind == "end_listen":
+        wav_bytes = _generate_beep_wav_bytes(1200, 180, volume=0.99)
+    elif kind == "startup":
+        wav_bytes = _generate_beep_wav_bytes(800, 300, volume=0.99)
+    else:
+        wav_bytes = _generate_beep_wav_bytes(1200, 200, volume=0.55)
+    sink = _current_sink()
+    if sink is not None:
+        try:
+            with wave.open(io.BytesIO(wav_bytes), "rb") as rdr:
+                frames = rdr.readframes(rdr.getnframes())
+                rate, channels = rdr.getframerate(), rdr.getnchannels()
+            if sink.play(frames, rate, channels):
+                return
+        except Exception:
+            pass
+    _play_wav_bytes(wav_bytes)
 
-        aplay_cmd = ["aplay", "-q", "-t", "wav"] + _aplay_tuning_args() + ["-"]
-        dev = os.getenv("APLAY_DEVICE")
-        if dev:
-            aplay_cmd = ["aplay", "-q", "-D", dev, "-t", "wav"] + _aplay_tuning_args() + ["-"]
+
+def _play_wav_bytes(wav_bytes: bytes, retry: bool = True) -> None:
+    """Reproduce un WAV en memoria con aplay por la ruta cacheada."""
+    route = _router.current()
+    dev = route.device if route.backend == "aplay" else ""
+    try:
+        aplay_cmd = ["aplay", "-q"] + (["-D", dev] if dev else []) + ["-t", "wav"] + _aplay_tuning_args() + ["-"]
         p = subprocess.run(aplay_cmd, input=wav_bytes, capture_output=True)
         if p.returncode != 0:
             try:
                 err = (p.stderr or b"").decode(errors="ignore").strip()
                 if err:
-                    print(f"[TTS] aplay earcon error ({dev or 'por defecto'}): {err}")
+                    print(f"[TTS] aplay error ({dev or 'por defecto'}): {err}")
             except Exception:
                 pass
-            # Reintentar con 'default' si cualquier dispositivo personalizado falla
-            if dev:
-                subprocess.run(["aplay", "-q", "-D", "default", "-t", "wav"] + _aplay_tuning_args() + ["-"], input=wav_bytes)
+            # Solo se culpa a la ruta si era de aplay: con sounddevice este
+            # respaldo usa el dispositivo por defecto, no la ruta cacheada
+            if route.backend == "aplay":
+                _router.failed(route)
+                if retry:
+                    _play_wav_bytes(wav_bytes, retry=False)
     except Exception:
         # No romper el flujo por un beep
         pass
 
 
+# Avisos que se sintetizan al arrancar: cuando un servicio está caído se
+# responden al instante, sin depender de nada remoto ni esperar a Piper
+CANNED_PHRASES = {
+    "llm_down": "Ahora mismo no puedo contactar con el servidor de inteligencia artificial. Inténtalo en un momento.",
+    "weather_down": "El servicio del tiempo no responde ahora mismo. Inténtalo más tarde.",
+    "timeout": "Lo siento, está tardando demasiado. Inténtalo de nuevo.",
+}
+_canned_pcm: dict = {}  # texto → PCM ya sintetizado
+
+
+def prepare_canned_phrases() -> None:
+    """Sintetiza en segundo plano los avisos de CANNED_PHRASES."""
+    def run() -> None:
+        for key, text in CANNED_PHRASES.items():
+            try:
+                pcm = b"".join(_tts.synthesize(text))
+                if pcm:
+                    _canned_pcm[text] = pcm
+            except Exception as exc:
+                print(f"[TTS] No se pudo presintetizar el aviso '{key}': {exc}")
+        print(f"[TTS] Avisos presintetizados: {len(_canned_pcm)}/{len(CANNED_PHRASES)}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
 def play_startup_beep() -> None:
     """Reproduce un pitido de inicio cuando el asistente se arranca."""
     try:
@@ -949,8 +2251,17 @@ class AudioPipeline:
     opcionalmente pasando por sox para convertir a parámetros que el hw acepte.
     """
 
-    def __init__(self, input_rate: int) -> None:
+    def __init__(self, input_rate: int, device: Optional[str] = None,
+                 min_flush_bytes: Optional[int] = None, convert: Optional[bool] = None,
+                 preflight: bool = True) -> None:
         self.input_rate = int(input_rate)
+        # None = APLAY_DEVICE; "" = dispositivo por defecto de aplay
+        self.device = os.getenv("APLAY_DEVICE", "") if device is None else device
+        # convert: pasar por sox (None = solo en hw: si hay sox). Con una ruta ya
+        # sondeada no hace falta el preflight (espera de 50 ms + reintento)
+        self.convert = convert
+        self.preflight = preflight
+        self.failed = False
         self.proc_sox: Optional[subprocess.Popen] = None
         self.proc_play: Optional[subprocess.Popen] = None
         self.stdin = None
@@ -959,13 +2270,16 @@ class AudioPipeline:
             self._min_flush_bytes = int(os.getenv("APLAY_MIN_CHUNK_BYTES", "16384"))
         except Exception:
             self._min_flush_bytes = 16384
+        if min_flush_bytes is not None:
+            self._min_flush_bytes = int(min_flush_bytes)
         self._start_pipeline()
 
     def _start_pipeline(self) -> None:
-        device = os.getenv("APLAY_DEVICE", "")
+        device = self.device
         have_sox = shutil.which("sox") is not None
         # Preferir conversión con sox si el destino es hw:*
-        if device.startswith("hw:") and have_sox:
+        use_sox = device.startswith("hw:") and have_sox if self.convert is None else self.convert
+        if use_sox:
             print(f"[TTS-Pipeline] Usando sox → aplay (hw: conversión 48k/16bit/2ch) en {device}")
             sox_cmd = [
                 "sox",
@@ -1000,7 +2314,8 @@ class AudioPipeline:
             )
             # Preflight: comprobar que aplay quedó vivo
             try:
-                time.sleep(0.05)
+                if self.preflight:
+                    time.sleep(0.05)
                 if self.proc_play.poll() not in (None,):
                     raise RuntimeError("aplay terminó prematuramente")
             except Exception:
@@ -1091,7 +2406,8 @@ class AudioPipeline:
                     self.stdin.flush()
                 except Exception:
                     pass
-                time.sleep(0.05)
+                if self.preflight:
+                    time.sleep(0.05)
                 if self.proc_play.poll() not in (None,):
                     raise RuntimeError("aplay terminó prematuramente")
             except Exception:
@@ -1142,7 +2458,13 @@ class AudioPipeline:
                     pass
         except Exception:
             # Intentar no romper la app si el dispositivo desaparece
-            pass
+            self.failed = True
+
+    @property
+    def ok(self) -> bool:
+        """Tras close(): ¿se entregó todo el audio sin errores?"""
+        rc = self.proc_play.returncode if self.proc_play is not None else 1
+        return not self.failed and rc in (0, None)
 
     def close(self) -> None:
         try:
@@ -1152,7 +2474,7 @@ class AudioPipeline:
                         try:
                             self.stdin.write(self._buffer)
                         except Exception:
-                            pass
+                            self.failed = True
                         self._buffer.clear()
                     self.stdin.flush()
                 except Exception:
@@ -1175,6 +2497,638 @@ class AudioPipeline:
                     pass
 
 
+def _piper_sample_rate() -> int:
+    """Frecuencia de la voz según su .json, sin cargar el modelo."""
+    try:
+        with open(PIPER_CONFIG, "r", encoding="utf-8") as f:
+            return int(json.load(f)["audio"]["sample_rate"])
+    except Exception:
+        return 22050
+
+
+def _drain_stderr(proc: Optional[subprocess.Popen]) -> None:
+    """Vacía el stderr de un proceso de larga vida (si se llena, el proceso se bloquea)."""
+    if proc is None or proc.stderr is None:
+        return
+
+    def run() -> None:
+        try:
+            for line in iter(proc.stderr.readline, b""):
+                msg = line.decode(errors="ignore").strip()
+                if msg:
+                    print(f"[Audio] {msg}")
+        except Exception:
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+class OutputRoute(NamedTuple):
+    """Ruta de salida que funciona: backend, dispositivo y formato que acepta."""
+    backend: str  # "sounddevice" | "aplay"
+    device: str  # "" = dispositivo por defecto
+    rate: int
+    channels: int
+    convert: bool  # aplay: convertir con sox a 48 kHz estéreo antes del dispositivo
+
+    def describe(self) -> str:
+        conv = " (sox)" if self.convert else ""
+        return f"{self.backend}:{self.device or 'default'}@{self.rate}Hz/{self.channels}ch{conv}"
+
+
+def _audio_devices_signature() -> str:
+    """Huella de la lista de tarjetas y de la configuración de salida: si
+    cambia (se conecta o se quita un dispositivo), la ruta cacheada no vale."""
+    try:
+        with open("/proc/asound/cards", "rb") as f:
+            cards = f.read()
+    except Exception:
+        cards = b""
+    conf = f"{os.getenv('APLAY_DEVICE', '')}|{AUDIO_SINK}|{AUDIO_BACKEND}".encode()
+    return hashlib.sha1(cards + b"|" + conf).hexdigest()[:16]
+
+
+def _sounddevice_format(rate: int) -> Tuple[str, int, int]:
+    """(nombre, frecuencia, canales): primera combinación PCM16 que acepta la salida de PortAudio."""
+    info = sd.query_devices(None, "output")
+    max_ch = int(info.get("max_output_channels", 0))
+    if max_ch < 1:
+        raise RuntimeError(f"'{info.get('name')}' no tiene salida")
+    rates = [int(rate), int(info.get("default_samplerate", 0)), 48000, 44100]
+    for candidate in dict.fromkeys(r for r in rates if r > 0):
+        for channels in (1, 2) if max_ch >= 2 else (1,):
+            try:
+                sd.check_output_settings(channels=channels, dtype="int16", samplerate=candidate)
+                return str(info.get("name", "")), candidate, channels
+            except Exception:
+                continue
+    raise RuntimeError(f"'{info.get('name')}' no acepta PCM16 a {rates}")
+
+
+def _aplay_accepts(route: OutputRoute) -> bool:
+    """Lanza aplay con 20 ms de silencio en el formato de la ruta."""
+    cmd = ["aplay", "-q"] + (["-D", route.device] if route.device else []) + [
+        "-t", "raw", "-f", "S16_LE", "-c", str(route.channels), "-r", str(route.rate), "-"]
+    silence = b"\x00\x00" * route.channels * max(1, route.rate // 50)
+    try:
+        return subprocess.run(cmd, input=silence, capture_output=True, timeout=3).returncode == 0
+    except Exception:
+        return False
+
+
+class OutputRouter:
+    """Descubre una vez la ruta de salida de audio y la cachea.
+
+    Antes cada respuesta y cada pitido probaban APLAY_DEVICE, 'default',
+    plughw y sox a base de lanzar procesos y esperar fallos. Ahora se sondea
+    al arrancar (o se reutiliza la del disco si no han cambiado las tarjetas
+    ni la configuración) y solo se vuelve a sondear si la ruta falla o cambia
+    la lista de dispositivos. Las rutas que fallaron se prueban las últimas.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._route: Optional[OutputRoute] = None
+        self._signature = ""
+        self._failed: set = set()
+        self._lock = threading.Lock()
+
+    def _candidates(self, rate: int) -> list:
+        configured = os.getenv("APLAY_DEVICE", "")
+        routes = []
+        if AUDIO_SINK and AUDIO_BACKEND == "sounddevice":
+            try:
+                name, dev_rate, channels = _sounddevice_format(rate)
+                routes.append(OutputRoute("sounddevice", name, dev_rate, channels, False))
+            except Exception as exc:
+                print(f"[Audio] sounddevice no sirve como salida: {exc}")
+        if configured.startswith("hw:") and shutil.which("sox") is not None:
+            routes.append(OutputRoute("aplay", configured, 48000, 2, True))
+        if configured:
+            routes.append(OutputRoute("aplay", configured, rate, 1, False))
+        if configured.startswith("hw:"):
+            routes.append(OutputRoute("aplay", "plughw:" + configured.split(":", 1)[1], rate, 1, False))
+        routes.append(OutputRoute("aplay", "", rate, 1, False))
+        # Las que ya fallaron, al final (quizá solo estaban ocupadas)
+        return [r for r in routes if r not in self._failed] + [r for r in routes if r in self._failed]
+
+    def _probe(self, signature: str) -> OutputRoute:
+        t0 = time.perf_counter()
+        tried = []
+        chosen: Optional[OutputRoute] = None
+        candidates = self._candidates(_piper_sample_rate())
+        for route in candidates:
+            # sounddevice ya se validó con check_output_settings al generar el candidato
+            ok = route.backend == "sounddevice" or _aplay_accepts(route)
+            tried.append({"route": route.describe(), "ok": ok})
+            if ok:
+                chosen = route
+                break
+        if chosen is None:
+            chosen = candidates[-1]
+            print("[Audio] Ninguna ruta de salida respondió; se usa el dispositivo por defecto")
+        _metrics.incr("audio.route_probes")
+        _metrics.observe("audio.route_probe_ms", 1000.0 * (time.perf_counter() - t0))
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"signature": signature, "route": chosen._asdict(), "tried": tried,
+                           "probed_at": datetime.now().isoformat(timespec="seconds")}, f, ensure_ascii=False, indent=2)
+        except Exception as exc:
+            print(f"[Audio] No se pudo guardar la ruta de salida: {exc}")
+        print(f"[Audio] Ruta de salida sondeada: {chosen.describe()} ({len(tried)} probadas)")
+        return chosen
+
+    def _load(self, signature: str) -> Optional[OutputRoute]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("signature") == signature:
+                return OutputRoute(**data["route"])
+        except Exception:
+            pass
+        return None
+
+    def current(self) -> OutputRoute:
+        """Ruta en uso; solo sondea si no hay ninguna válida para los dispositivos actuales."""
+        signature = _audio_devices_signature()
+        with self._lock:
+            if self._route is not None and signature == self._signature:
+                return self._route
+            if signature != self._signature:
+                self._failed.clear()
+            route = self._load(signature) if self._route is None and not self._failed else None
+            source = "cache"
+            if route is None:
+                route = self._probe(signature)
+                source = "probe"
+            self._route, self._signature = route, signature
+            _metrics.set("audio.route", route.describe())
+            _metrics.set("audio.route_source", source)
+            return route
+
+    def failed(self, route: Optional[OutputRoute] = None) -> None:
+        """La ruta dejó de funcionar: la siguiente petición vuelve a sondear."""
+        with self._lock:
+            route = route or self._route
+            if route is None:
+                return
+            self._failed.add(route)
+            if route == self._route:
+                self._route = None
+            _metrics.incr("audio.route_failures")
+            print(f"[Audio] Falló la ruta de salida {route.describe()}; se volverá a sondear")
+
+
+_router = OutputRouter(AUDIO_ROUTE_PATH)
+
+
+class SinkStream:
+    """Un productor de PCM16 hacia la salida compartida.
+
+    Misma interfaz que AudioPipeline (write / close / ok), así que TTS,
+    avisos y pitidos no distinguen entre una y otra. Convierte a mono y a la
+    frecuencia de la salida si hace falta; close() espera a que suene todo.
+    """
+
+    def __init__(self, sink: "OutputSink", rate: int, channels: int = 1) -> None:
+        self.sink = sink
+        self.channels = max(1, int(channels))
+        self.failed = False
+        self._done = threading.Event()
+        self._done_at = 0.0
+        self._resampler: Optional[PolyphaseResampler] = None
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._in_total = 0
+        self._out_total = 0
+        if int(rate) != sink.rate:
+            mult = PolyphaseResampler.block_multiple(rate, sink.rate)
+            self._resampler = PolyphaseResampler(rate, sink.rate, mult * max(1, (int(rate) // 50) // mult))
+
+    def _convert(self, audio: np.ndarray, final: bool = False) -> bytes:
+        rs = self._resampler
+        if rs is None:
+            return audio.tobytes()
+        self._in_total += audio.size
+        audio = np.concatenate([self._pending, audio])
+        whole = audio.size - audio.size % rs.block_in
+        if final and whole < audio.size:
+            # Último trozo: completar el bloque con ceros y recortar la salida
+            padded = np.zeros(whole + rs.block_in, dtype=np.int16)
+            padded[:audio.size] = audio
+            audio, whole = padded, padded.size
+        self._pending = audio[whole:].copy()
+        out = b"".join(rs.process(audio[i:i + rs.block_in]).tobytes() for i in range(0, whole, rs.block_in))
+        if final:
+            expected = self._in_total * rs.up // rs.down
+            out = out[:2 * max(0, expected - self._out_total)]
+        self._out_total += len(out) // 2
+        return out
+
+    def write(self, data: bytes) -> None:
+        if not data or self.failed:
+            return
+        audio = np.frombuffer(data[:len(data) - len(data) % (2 * self.channels)], dtype=np.int16)
+        if self.channels > 1:
+            audio = audio.reshape(-1, self.channels).mean(axis=1).astype(np.int16)
+        pcm = self._convert(audio)
+        if pcm:
+            self.sink._put(self, pcm)
+
+    def close(self, wait: bool = True) -> None:
+        if self._resampler is not None and self._pending.size:
+            pcm = self._convert(np.zeros(0, dtype=np.int16), final=True)
+            if pcm:
+                self.sink._put(self, pcm)
+        self.sink._put(self, None)
+        if not wait:
+            return
+        self._done.wait()
+        remaining = self._done_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+class OutputSink:
+    """Salida de audio única y persistente (un aplay, o sox → aplay en hw:).
+
+    Se abre al arrancar y no se cierra entre turnos: los productores encolan
+    PCM y un hilo lo escribe en orden, sin adelantarse más de SINK_LEAD_MS
+    a lo que está sonando (así el audio nuevo no espera detrás de silencio
+    acumulado en la tubería). Sin nada que reproducir rellena con silencio
+    para que el dispositivo no se vacíe; tras SINK_IDLE_PAD_SECS deja de
+    rellenar, de modo que la deriva de reloj del dispositivo no se acumula.
+    Si aplay muere, el productor afectado ve ok=False y la salida se reabre
+    por la ruta que indique OutputRouter.
+    """
+
+    backend = "aplay"
+
+    def __init__(self, rate: int) -> None:
+        self.rate = int(rate)
+        self.route: Optional[OutputRoute] = None
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._pipeline: Optional[AudioPipeline] = None
+        self._play_until = 0.0  # instante (monotonic) en que acaba de sonar lo escrito
+        self._last_audio = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._open()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Cierra la salida cuando termine lo ya encolado."""
+        self._queue.put((None, None))
+
+    def _put(self, stream: SinkStream, data: Optional[bytes]) -> None:
+        with self._lock:
+            if not self._stopped:
+                self._queue.put((stream, data))
+                return
+        # Salida ya cerrada (p.ej. sustituida por otra ruta): nadie leerá la cola
+        stream.failed = True
+        stream._done.set()
+
+    def _abandon_pending(self) -> None:
+        """Tras parar: los productores que aún tengan audio encolado ven ok=False
+        y su close() vuelve en vez de esperar un fin que nadie procesará."""
+        with self._lock:
+            self._stopped = True
+        while True:
+            try:
+                stream, _ = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if stream is not None:
+                stream.failed = True
+                stream._done.set()
+
+    def _close(self) -> None:
+        pipeline, self._pipeline = self._pipeline, None
+        if pipeline is not None:
+            pipeline.close()
+
+    def stream(self, rate: int, channels: int = 1) -> SinkStream:
+        return SinkStream(self, rate, channels)
+
+    def play(self, pcm: bytes, rate: int, channels: int = 1, wait: bool = True) -> bool:
+        """Encola un clip completo. Con wait=True vuelve cuando ha sonado."""
+        stream = self.stream(rate, channels)
+        stream.write(pcm)
+        stream.close(wait=wait)
+        return stream.ok
+
+    def _open(self) -> Optional[AudioPipeline]:
+        if self._pipeline is None:
+            route = _router.current()
+            if route.backend != self.backend:
+                return None
+            try:
+                t0 = time.perf_counter()
+                self.route = route
+                self._pipeline = AudioPipeline(self.rate, device=route.device, min_flush_bytes=0,
+                                               convert=route.convert, preflight=False)
+                _drain_stderr(self._pipeline.proc_play)
+                _drain_stderr(self._pipeline.proc_sox)
+                _metrics.incr("audio.sink_opens")
+                _metrics.observe("audio.sink_open_ms", 1000.0 * (time.perf_counter() - t0))
+                self._play_until = time.monotonic()
+            except Exception as exc:
+                print(f"[Audio] No se pudo abrir la salida de audio: {exc}")
+                self._pipeline = None
+                _router.failed(route)
+        return self._pipeline
+
+    def _reset(self) -> None:
+        pipeline, self._pipeline = self._pipeline, None
+        _metrics.incr("audio.sink_failures")
+        _router.failed(self.route)
+        print("[Audio] La salida de audio falló; se reabrirá con el siguiente audio")
+        if pipeline is None:
+            return
+        for proc in (pipeline.proc_play, pipeline.proc_sox):
+            try:
+                if proc is not None:
+                    proc.kill()
+            except Exception:
+                pass
+
+    def _write(self, stream: Optional[SinkStream], data: bytes) -> None:
+        lead = SINK_LEAD_MS / 1000.0
+        step = 2 * max(1, self.rate // 50)  # 20 ms
+        for off in range(0, len(data), step):
+            piece = data[off:off + step]
+            delay = self._play_until - time.monotonic() - lead
+            if delay > 0:
+                time.sleep(delay)
+            pipeline = self._open()
+            if pipeline is not None:
+                pipeline.write(piece)
+            if pipeline is None or pipeline.failed or pipeline.proc_play is None or pipeline.proc_play.poll() is not None:
+                if pipeline is not None:
+                    self._reset()
+                if stream is not None:
+                    stream.failed = True
+                return
+            self._play_until = max(self._play_until, time.monotonic()) + len(piece) / (2.0 * self.rate)
+        if stream is not None:
+            self._last_audio = time.monotonic()
+
+    def _flush(self) -> None:
+        """Fin de un productor: entregar lo que quede retenido (nada en aplay)."""
+
+    def _needs_padding(self) -> bool:
+        return self._pipeline is not None and time.monotonic() - self._last_audio < SINK_IDLE_PAD_SECS
+
+    def _run(self) -> None:
+        silence = b"\x00\x00" * max(1, self.rate // 50)
+        lead = SINK_LEAD_MS / 1000.0
+        while True:
+            try:
+                padding = self._needs_padding()
+                timeout = max(0.001, self._play_until - time.monotonic() - lead / 2) if padding else None
+                try:
+                    stream, data = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    self._write(None, silence)
+                    continue
+                if stream is None:
+                    self._abandon_pending()
+                    self._close()
+                    return
+                if data is None:
+                    self._flush()
+                    stream._done_at = self._play_until
+                    stream._done.set()
+                elif not stream.failed:
+                    self._write(stream, data)
+            except Exception as exc:
+                print(f"[Audio] Error en la salida de audio: {exc}")
+                time.sleep(0.1)
+
+
+class SoundDeviceSink(OutputSink):
+    """Salida persistente con sd.RawOutputStream, sin procesos ni tuberías.
+
+    El PCM mono de la salida se remuestrea (PolyphaseResampler) y se duplica
+    a los canales del dispositivo en proceso, y se deja en un buffer acotado
+    del que tira el callback de PortAudio; si no hay nada, el callback
+    entrega silencio (el relleno es gratis y no hay deriva que acumular).
+    La latencia de salida la informa PortAudio en cada callback.
+    """
+
+    backend = "sounddevice"
+
+    def __init__(self, rate: int) -> None:
+        super().__init__(rate)
+        self.device_rate = self.rate
+        self.channels = 1
+        self._stream: Optional[sd.RawOutputStream] = None
+        self._resampler: Optional[PolyphaseResampler] = None
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._buf = bytearray()
+        self._buf_lock = threading.Lock()
+        self._dac_latency = 0.0
+        self._underflows = 0
+
+    def _callback(self, outdata, frames, time_info, status) -> None:
+        if status:
+            self._underflows += 1
+        n = len(outdata)
+        with self._buf_lock:
+            take = min(n, len(self._buf))
+            outdata[:take] = self._buf[:take]
+            del self._buf[:take]
+        if take < n:
+            outdata[take:] = b"\x00" * (n - take)
+        try:
+            self._dac_latency = max(0.0, time_info.outputBufferDacTime - time_info.currentTime)
+        except Exception:
+            pass
+
+    def _open(self):
+        if self._stream is None:
+            route = _router.current()
+            if route.backend != self.backend:
+                return None
+            try:
+                t0 = time.perf_counter()
+                self.route = route
+                self.device_rate, self.channels = route.rate, route.channels
+                self._resampler = None
+                self._pending = np.zeros(0, dtype=np.int16)
+                if self.device_rate != self.rate:
+                    mult = PolyphaseResampler.block_multiple(self.rate, self.device_rate)
+                    self._resampler = PolyphaseResampler(
+                        self.rate, self.device_rate, mult * max(1, (self.rate // 50) // mult))
+                stream = sd.RawOutputStream(
+                    samplerate=self.device_rate,
+                    channels=self.channels,
+                    dtype="int16",
+                    latency="low",
+                    callback=self._callback,
+                    device=route.device or None,
+                )
+                stream.start()
+                self._stream = stream
+                self._dac_latency = float(stream.latency)
+                _metrics.incr("audio.sink_opens")
+                _metrics.observe("audio.sink_open_ms", 1000.0 * (time.perf_counter() - t0))
+                conv = f" (remuestreo {self.rate} → {self.device_rate} Hz en proceso)" if self._resampler else ""
+                print(f"[Audio] Salida sounddevice @ {self.device_rate}Hz, {self.channels} canal(es){conv}, "
+                      f"latencia {1000.0 * self._dac_latency:.0f} ms")
+            except Exception as exc:
+                print(f"[Audio] No se pudo abrir la salida sounddevice: {exc}")
+                self._stream = None
+                _router.failed(route)
+        return self._stream
+
+    def _reset(self) -> None:
+        stream, self._stream = self._stream, None
+        _metrics.incr("audio.sink_failures")
+        _router.failed(self.route)
+        print("[Audio] La salida sounddevice falló; se reabrirá con el siguiente audio")
+        with self._buf_lock:
+            self._buf.clear()
+        if stream is not None:
+            try:
+                stream.abort()
+                stream.close()
+            except Exception:
+                pass
+
+    def _needs_padding(self) -> bool:
+        return False
+
+    def _close(self) -> None:
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.stop()
+                stream.close()
+            except Exception:
+                pass
+
+    def _device_pcm(self, mono: np.ndarray) -> bytes:
+        rs = self._resampler
+        if rs is not None:
+            mono = np.concatenate([self._pending, mono])
+            whole = mono.size - mono.size % rs.block_in
+            self._pending = mono[whole:].copy()
+            parts = [rs.process(mono[i:i + rs.block_in]).copy() for i in range(0, whole, rs.block_in)]
+            mono = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+        if self.channels > 1:
+            mono = np.repeat(mono, self.channels)
+        return mono.tobytes()
+
+    def _flush(self) -> None:
+        rs = self._resampler
+        if rs is None or not self._pending.size or self._stream is None:
+            return
+        tail = self._pending.size
+        pcm = self._device_pcm(np.zeros(rs.block_in - tail, dtype=np.int16))
+        keep = tail * rs.up // rs.down * 2 * self.channels
+        with self._buf_lock:
+            self._buf.extend(pcm[:keep])
+        self._play_until = time.monotonic() + self._buffered_secs() + self._dac_latency
+
+    def _buffered_secs(self) -> float:
+        return len(self._buf) / (2.0 * self.channels * self.device_rate)
+
+    def _write(self, stream: Optional[SinkStream], data: bytes) -> None:
+        lead = SINK_LEAD_MS / 1000.0
+        step = 2 * max(1, self.rate // 50)  # 20 ms
+        for off in range(0, len(data), step):
+            if self._open() is None or not self._stream.active:
+                if self._stream is not None:
+                    self._reset()
+                if stream is not None:
+                    stream.failed = True
+                return
+            pcm = self._device_pcm(np.frombuffer(data[off:off + step], dtype=np.int16))
+            # Contrapresión: no llenar más de SINK_LEAD_MS por delante del callback
+            deadline = time.monotonic() + lead + 1.0
+            while self._buffered_secs() > lead and time.monotonic() < deadline:
+                time.sleep(0.005)
+            if self._buffered_secs() > lead:
+                # El callback dejó de pedir audio: dispositivo colgado
+                self._reset()
+                if stream is not None:
+                    stream.failed = True
+                return
+            with self._buf_lock:
+                self._buf.extend(pcm)
+            self._play_until = time.monotonic() + self._buffered_secs() + self._dac_latency
+        if stream is not None:
+            self._last_audio = time.monotonic()
+            _metrics.set("audio.output_latency_ms", round(1000.0 * self._dac_latency, 1))
+            if self._underflows:
+                _metrics.incr("audio.output_underflows", self._underflows)
+                self._underflows = 0
+
+
+_output: Optional[OutputSink] = None
+
+
+def start_output_sink() -> None:
+    """Abre la salida persistente (AUDIO_SINK=0 vuelve a un aplay por respuesta)."""
+    global _output
+    if not AUDIO_SINK or _output is not None:
+        return
+    _output = _make_sink(_router.current())
+    _output.start()
+    if _output._open() is None:
+        # La ruta cacheada no abrió: se vuelve a sondear y se prueba la siguiente
+        _output = _current_sink()
+    print(f"[Audio] Salida persistente abierta a {_output.rate} Hz por {_router.current().describe()}")
+
+
+def _make_sink(route: OutputRoute) -> OutputSink:
+    rate = _piper_sample_rate()
+    return SoundDeviceSink(rate) if route.backend == "sounddevice" else OutputSink(rate)
+
+
+_output_lock = threading.Lock()
+
+
+def _current_sink() -> Optional[OutputSink]:
+    """Salida compartida acorde con la ruta vigente (se sustituye si cambia de backend)."""
+    global _output
+    if _output is None:
+        return None
+    with _output_lock:
+        route = _router.current()
+        if route.backend != _output.backend:
+            old, _output = _output, _make_sink(route)
+            _output.start()
+            old.stop()
+            print(f"[Audio] Salida cambiada a {route.describe()}")
+        return _output
+
+
+def open_output(rate: int):
+    """Canal para un productor de audio: la salida compartida si está abierta,
+    si no un aplay por la ruta cacheada."""
+    sink = _current_sink()
+    if sink is not None:
+        return sink.stream(rate)
+    route = _router.current()
+    if route.backend != "aplay":
+        return AudioPipeline(rate)
+    return AudioPipeline(rate, device=route.device, convert=route.convert, preflight=False)
+
+
 def _looks_like_sentence_end(buffer: str) -> bool:
     if not buffer:
         return False
@@ -1192,19 +3146,43 @@ def _looks_like_sentence_end(buffer: str) -> bool:
     return False
 
 
-def stream_and_speak_from_ollama(messages: list) -> str:
+def stream_and_speak_from_ollama(messages: list, gate: Optional[threading.Event] = None,
+                                 cancel: Optional[threading.Event] = None) -> str:
+    """Pide la respuesta en streaming y la va locutando por frases.
+
+    Con 'gate' el texto se pide ya pero el audio espera a que se abra la
+    compuerta (el canal de audio ni se abre hasta entonces). Con 'cancel' se
+    aborta: se cierra el stream de Ollama (corta la generación en el servidor)
+    y no se locuta nada pendiente.
+    """
     print("[Streaming IA] Iniciando stream con Ollama y TTS en frases…")
     text_queue: "queue.Queue[Optional[str]]" = queue.Queue()
     full_reply: str = ""
-    # Usar piper-tts directamente sobre una tubería continua para evitar cortes
-    global _piper_voice
-    if _piper_voice is None:
-        from piper.voice import PiperVoice  # type: ignore
-        _piper_voice = PiperVoice.load(PIPER_MODEL, PIPER_CONFIG)
-    print(f"[TTS-Pipeline] Inicializando canal continuo a { _piper_voice.config.sample_rate } Hz")
-    pipeline = AudioPipeline(input_rate=_piper_voice.config.sample_rate)
+    # Antes de arrancar tts_worker, que lo usa
+    budget = current_budget()
+    # Voz en proceso (cargada una sola vez) sobre una tubería continua
+    _tts.voice()
+    pipeline = None
+
+    def ensure_pipeline():
+        nonlocal pipeline
+        if pipeline is None:
+            print(f"[TTS-Pipeline] Inicializando canal continuo a {_tts.sample_rate} Hz")
+            pipeline = open_output(_tts.sample_rate)
+        return pipeline
+
+    if gate is None:
+        ensure_pipeline()
+
+    synthesis: Optional[OrderedSynthesis] = None
+    player: Optional[threading.Thread] = None
+
+    def play_in_order() -> None:
+        for data in synthesis.pcm():
+            ensure_pipeline().write(data)
 
     def tts_worker() -> None:
+        nonlocal synthesis, player
         while True:
             segment = text_queue.get()
             try:
@@ -1213,75 +3191,18 @@ def stream_and_speak_from_ollama(messages: list) -> str:
                 seg = segment.strip()
                 if not seg:
                     continue
-                print(f"[TTS-Pipeline] Sintetizando segmento ({len(seg)} chars)…")
-                # 1) Intento: extraer PCM directamente del iterador de piper-tts
-                def to_bytes(obj) -> bytes:
-                    if obj is None:
-                        return b""
-                    if isinstance(obj, (bytes, bytearray)):
-                        return bytes(obj)
-                    try:
-                        return memoryview(obj).tobytes()  # type: ignore[arg-type]
-                    except Exception:
-                        pass
-                    if hasattr(obj, 'tobytes'):
-                        try:
-                            return obj.tobytes()
-                        except Exception:
-                            pass
-                    if hasattr(obj, 'astype'):
-                        try:
-                            return obj.astype('<i2').tobytes()
-                        except Exception:
-                            pass
-                    try:
-                        return bytes(obj)
-                    except Exception:
-                        return b""
-
-                pcm_bytes_total = 0
-                first_chunk_info = None
-                try:
-                    for idx, chunk in enumerate(_piper_voice.synthesize(seg)):
-                        try:
-                            data = b""
-                            if hasattr(chunk, 'pcm'):
-                                data = to_bytes(getattr(chunk, 'pcm'))
-                            elif hasattr(chunk, 'data'):
-                                data = to_bytes(getattr(chunk, 'data'))
-                            else:
-                                data = to_bytes(chunk)
-                            if idx < 3 and first_chunk_info is None and data == b"":
-                                first_chunk_info = f"tipo={type(chunk)} attrs={dir(chunk)[:6]}"
-                            if data:
-                                pcm_bytes_total += len(data)
-                                pipeline.write(data)
-                        except Exception:
-                            continue
-                except Exception:
-                    pass
-
-                # 2) Si no llegó PCM, usar CLI de Piper y extraer frames WAV
-                used_cli = False
-                if pcm_bytes_total == 0:
-                    try:
-                        cmd = ["piper", "-m", PIPER_MODEL, "-c", PIPER_CONFIG, "-f", "-"]
-                        proc = subprocess.run(cmd, input=(seg + "\n").encode('utf-8'), capture_output=True)
-                        used_cli = True
-                        wav_bytes = proc.stdout
-                        if wav_bytes:
-                            rdr = wave.open(io.BytesIO(wav_bytes), 'rb')
-                            frames = rdr.readframes(rdr.getnframes())
-                            rdr.close()
-                            if frames:
-                                pipeline.write(frames)
-                                pcm_bytes_total = len(frames)
-                    except Exception:
-                        pcm_bytes_total = 0
-
-                if first_chunk_info and pcm_bytes_total == 0:
-                    print(f"[TTS-Pipeline] Diagnóstico primer chunk vacío: {first_chunk_info}")
-                print(f"[TTS-Pipeline] Segmento enviado ({pcm_bytes_total} bytes){' [cli]' if used_cli else ''}")
+                if gate is not None:
+                    gate.wait()
+                if cancel is not None and cancel.is_set():
+                    continue
+                if budget is not None:
+                    budget.first_audio()
+                if synthesis is None:
+                    synthesis = OrderedSynthesis(_tts)
+                    player = threading.Thread(target=play_in_order, daemon=True)
+                    player.start()
+                print(f"[TTS-Pipeline] Frase encolada para síntesis ({len(seg)} chars)")
+                synthesis.submit(seg)
             finally:
                 text_queue.task_done()
 
@@ -1289,30 +3210,35 @@ def stream_and_speak_from_ollama(messages: list) -> str:
     worker_thread.start()
 
     buffer: str = ""
+    stream = None
+    failure: Optional[str] = None
+    t0 = time.perf_counter()
+    first_token_ms: Optional[float] = None
     try:
-        if OLLAMA_HOST:
-            client = ollama.Client(host=OLLAMA_HOST)
-            stream = client.chat(
-                model=OLLAMA_MODEL,
-                messages=messages,
-                stream=True,
-                options=OLLAMA_OPTIONS,
-            )
-        else:
-            stream = ollama.chat(
-                model=OLLAMA_MODEL,
-                messages=messages,
-                stream=True,
-                options=OLLAMA_OPTIONS,
-            )
+        question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        _, model, options = select_model("answer", question)
+        stream = _ollama_pool.stream_chat(messages, options, model, cancel=cancel)
 
         for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                print("[Streaming IA] Cancelado: se corta el stream")
+                buffer = ""
+                break
             try:
+                if chunk.get("done"):
+                    # El último fragmento trae load_duration: primer token en frío o en caliente
+                    _record_ollama_timing("stream_ttft", first_token_ms or 1000.0 * (time.perf_counter() - t0), chunk)
+                    _record_prompt_eval("stream", chunk)
+                    _metrics.observe("tier.main.answer_ms", 1000.0 * (time.perf_counter() - t0))
+                    if first_token_ms is not None:
+                        _metrics.observe("tier.main.answer_ttft_ms", first_token_ms)
                 piece = chunk.get("message", {}).get("content", "")
             except Exception:
                 piece = ""
             if not piece:
                 continue
+            if first_token_ms is None:
+                first_token_ms = 1000.0 * (time.perf_counter() - t0)
             full_reply += piece
             buffer += piece
             # Emitir por frases
@@ -1324,9 +3250,22 @@ def stream_and_speak_from_ollama(messages: list) -> str:
         if buffer.strip():
             text_queue.put(buffer)
             buffer = ""
+    except BackendUnavailable as exc:
+        print(f"[Streaming IA] {exc}")
+        failure = CANNED_PHRASES["llm_down"]
+    except DeadlineExceeded as exc:
+        print(f"[Streaming IA] {exc}")
+        failure = CANNED_PHRASES["timeout"]
     except Exception as exc:
         print(f"[Streaming IA] Error durante streaming: {exc}")
     finally:
+        # Cerrar el generador cierra la conexión HTTP y Ollama deja de generar
+        try:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        except Exception:
+            pass
         # Señal de fin
         text_queue.put(None)
         text_queue.join()
@@ -1334,12 +3273,70 @@ def stream_and_speak_from_ollama(messages: list) -> str:
             worker_thread.join(timeout=0.2)
         except Exception:
             pass
-        pipeline.close()
-        print("[TTS-Pipeline] Canal de audio cerrado")
-
+        if synthesis is not None:
+            if cancel is not None and cancel.is_set():
+                synthesis.cancel()
+            else:
+                synthesis.finish()
+            player.join()
+        if pipeline is not None:
+            pipeline.close()
+            if not pipeline.ok and isinstance(pipeline, AudioPipeline):
+                _router.failed()
+            print("[TTS-Pipeline] Canal de audio cerrado")
+
+    if failure and not full_reply.strip():
+        # Nada dicho todavía: aviso presintetizado en vez de silencio (si esta respuesta es la que vale)
+        if gate is not None:
+            gate.wait()
+        if cancel is None or not cancel.is_set():
+            speak(failure)
+        return FailedReply(failure)
     return full_reply.strip()
 
 
+def classify_with_parallel_answer(command: str) -> Tuple[IntentType, dict, Optional[str]]:
+    """Clasifica con la IA y, a la vez, pide ya la respuesta general.
+
+    El audio de la respuesta queda retenido hasta conocer la intención: si es
+    "other" se libera (y la respuesta ya lleva ventaja); si es una consulta
+    nativa se cancela el stream. Devuelve (intent, extras, respuesta o None).
+    """
+    gate = threading.Event()
+    cancel = threading.Event()
+    result: dict = {}
+
+    def answer() -> None:
+        try:
+            result["reply"] = stream_and_speak_from_ollama(build_ollama_messages(command), gate=gate, cancel=cancel)
+        except Exception as exc:
+            result["reply"] = FailedReply(f"Hubo un error consultando el modelo: {exc}")
+
+    worker = threading.Thread(target=answer, daemon=True)
+    t0 = time.perf_counter()
+    worker.start()
+    try:
+        intent, extras = classify_intent_via_llm(command)
+    except Exception:
+        intent, extras = detect_intent(command)
+    classify_ms = 1000.0 * (time.perf_counter() - t0)
+    if intent == "other":
+        # La respuesta llevaba ya todo este tiempo generándose
+        _metrics.incr("dispatch.answer_committed")
+        _metrics.observe("dispatch.saved_ms", classify_ms)
+        print(f"[Dispatch] Intención 'other': se libera la respuesta adelantada ({classify_ms:.0f} ms ganados)")
+        gate.set()
+        worker.join()
+        return intent, extras, result.get("reply", "")
+    _metrics.incr("dispatch.answer_cancelled")
+    print(f"[Dispatch] Intención '{intent}': se cancela la respuesta general")
+    cancel.set()
+    gate.set()
+    # No se espera al hilo: stream_chat aborta la respuesta HTTP por su cuenta y,
+    # con 'cancel' activo, el hilo ya no abre la salida de audio ni locuta nada
+    return intent, extras, None
+
+
 def create_recognizer() -> vosk.KaldiRecognizer:
     assert _vosk_model is not None
     rec = vosk.KaldiRecognizer(_vosk_model, SAMPLE_RATE)
@@ -1410,117 +3407,957 @@ def _discover_and_set_piper_voice() -> None:
         return
 
 
-def create_wake_recognizer() -> vosk.KaldiRecognizer:
-    assert _vosk_model is not None
-    grammar = json.dumps([WAKE_WORD])
-    recognizer = vosk.KaldiRecognizer(_vosk_model, SAMPLE_RATE, grammar)
-    recognizer.SetWords(False)
+def create_wake_recognizer(model: Optional[vosk.Model] = None) -> vosk.KaldiRecognizer:
+    model = model or _vosk_model
+    assert model is not None
+    # En modo one-shot, "[unk]" absorbe lo que siga a la wake word en la misma frase
+    grammar = json.dumps([WAKE_WORD, "[unk]"] if WAKE_ONESHOT else [WAKE_WORD])
+    recognizer = vosk.KaldiRecognizer(model, SAMPLE_RATE, grammar)
+    # Tiempos por palabra para saber en qué muestra terminó la wake word
+    recognizer.SetWords(True)
     return recognizer
 
 
-def wait_for_wake_word() -> None:
-    q: "queue.Queue[bytes]" = queue.Queue()
-    recognizer = create_wake_recognizer()
+def create_command_grammar_recognizer() -> Optional[vosk.KaldiRecognizer]:
+    """Reconocedor de primera pasada restringido a COMMAND_PHRASES (+ "[unk]").
 
-    def callback(indata, frames, t, status):
-        if status:
+    Los modelos grandes de Vosk tienen el grafo compilado y no admiten
+    gramáticas en tiempo de ejecución, así que se usa el modelo pequeño; sin
+    él la primera pasada queda desactivada y todo va al modelo completo.
+    """
+    if not COMMAND_GRAMMAR:
+        return None
+    model = _get_wake_model()
+    if model is _vosk_model:
+        print(f"[Comando] Gramática desactivada: falta el modelo pequeño en {VOSK_WAKE_MODEL_DIR}")
+        return None
+    grammar = json.dumps(sorted(COMMAND_PHRASES) + ["[unk]"], ensure_ascii=False)
+    recognizer = vosk.KaldiRecognizer(model, SAMPLE_RATE, grammar)
+    # Confianza por palabra para decidir si hace falta la segunda pasada
+    recognizer.SetWords(True)
+    return recognizer
+
+
+# =====================
+# Detectores de wake word
+# =====================
+
+class WakeDetection(NamedTuple):
+    end_s: Optional[float]  # fin de la wake word en s desde el último reset (None si se desconoce)
+    text: str
+    trailing: bool  # la frase sigue tras la wake word (modo one-shot)
+
+
+class WakeWordEngine(ABC):
+    """Interfaz común de los detectores de wake word.
+
+    accept() recibe PCM16 mono a SAMPLE_RATE y devuelve una WakeDetection
+    cuando oye la wake word; flush() decide sobre el audio pendiente y reset()
+    empieza de cero (los tiempos de WakeDetection son relativos al reset).
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def reset(self) -> None:
+        ...
+
+    @abstractmethod
+    def accept(self, data: bytes) -> Optional[WakeDetection]:
+        ...
+
+    def flush(self) -> Optional[WakeDetection]:
+        return None
+
+
+class VoskWakeEngine(WakeWordEngine):
+    """Wake word con gramática de Vosk (con "[unk]" en modo one-shot)."""
+
+    def __init__(self, model: vosk.Model, name: str = "vosk") -> None:
+        self.name = name
+        self.recognizer = create_wake_recognizer(model)
+
+    def reset(self) -> None:
+        self.recognizer.Reset()
+
+    def accept(self, data: bytes) -> Optional[WakeDetection]:
+        if _accept_waveform(self.recognizer, data):
+            return self._parse(json.loads(self.recognizer.Result()))
+        return None
+
+    def flush(self) -> Optional[WakeDetection]:
+        return self._parse(json.loads(self.recognizer.FinalResult()))
+
+    @staticmethod
+    def _parse(res: dict) -> Optional[WakeDetection]:
+        txt = res.get("text", "").lower().strip()
+        tokens = txt.split()
+        if txt == WAKE_WORD:
+            trailing = False
+        elif WAKE_ONESHOT and len(tokens) > 1 and tokens[0] == WAKE_WORD:
+            trailing = True
+        else:
+            return None
+        end_s = None
+        try:
+            ends = [w.get("end") for w in (res.get("result") or []) if str(w.get("word", "")).lower() == WAKE_WORD]
+            if ends:
+                end_s = float(ends[0])
+        except Exception:
             pass
-        q.put(bytes(indata))
+        return WakeDetection(end_s, txt, trailing)
+
+
+def _mel_filterbank(samplerate: int, nfft: int, n_mels: int) -> np.ndarray:
+    def hz_to_mel(f):
+        return 2595.0 * np.log10(1.0 + f / 700.0)
+
+    def mel_to_hz(m):
+        return 700.0 * (10.0 ** (m / 2595.0) - 1.0)
+
+    mels = np.linspace(hz_to_mel(20.0), hz_to_mel(samplerate / 2.0), n_mels + 2)
+    bins = np.floor((nfft + 1) * mel_to_hz(mels) / samplerate).astype(int)
+    fb = np.zeros((n_mels, nfft // 2 + 1), dtype=np.float32)
+    for m in range(1, n_mels + 1):
+        left, center, right = bins[m - 1], bins[m], bins[m + 1]
+        if center > left:
+            fb[m - 1, left:center] = (np.arange(left, center) - left) / (center - left)
+        if right > center:
+            fb[m - 1, center:right] = (right - np.arange(center, right)) / (right - center)
+    return fb
+
+
+class MfccExtractor:
+    """MFCC en streaming con NumPy (ventana 25 ms, salto 10 ms, sin c0)."""
+
+    def __init__(self, samplerate: int, n_mfcc: int = 13, n_mels: int = 26) -> None:
+        self.samplerate = int(samplerate)
+        self.win = int(0.025 * self.samplerate)
+        self.hop = int(0.010 * self.samplerate)
+        self.nfft = 1 << (self.win - 1).bit_length()
+        self.n_mfcc = n_mfcc
+        self._window = np.hamming(self.win).astype(np.float32)
+        self._mel = _mel_filterbank(self.samplerate, self.nfft, n_mels)
+        k = np.arange(n_mfcc + 1)[:, None]
+        n = np.arange(n_mels)[None, :]
+        self._dct = np.cos(np.pi * k * (2 * n + 1) / (2.0 * n_mels)).astype(np.float32)[1:]
+        self._carry = np.zeros(0, dtype=np.float32)
+
+    def reset(self) -> None:
+        self._carry = np.zeros(0, dtype=np.float32)
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        """Devuelve las tramas MFCC completas (n, n_mfcc) que aporta este bloque."""
+        x = np.concatenate((self._carry, audio.astype(np.float32)))
+        n = 0 if x.size < self.win else 1 + (x.size - self.win) // self.hop
+        if n == 0:
+            self._carry = x
+            return np.zeros((0, self.n_mfcc), dtype=np.float32)
+        idx = np.arange(self.win)[None, :] + self.hop * np.arange(n)[:, None]
+        frames = x[idx]
+        frames[:, 1:] -= 0.97 * frames[:, :-1].copy()  # pre-énfasis
+        spec = np.abs(np.fft.rfft(frames * self._window, n=self.nfft)) ** 2
+        ceps = np.log(spec @ self._mel.T + 1e-6) @ self._dct.T
+        self._carry = x[n * self.hop:]
+        return ceps.astype(np.float32)
+
+
+class TemplateWakeEngine(WakeWordEngine):
+    """Detector por plantillas (keyword spotting) sobre MFCC, todo en NumPy.
+
+    Cada plantilla es una grabación de la wake word. Para cada trama nueva se
+    toman ventanas del flujo con varias velocidades (STRETCH), se reescalan al
+    largo de la plantilla y se puntúan con la similitud coseno media por trama
+    tras normalizar la media cepstral. No transcribe, así que no hace one-shot.
+    """
 
-    try:
-        with sd.RawInputStream(
-            samplerate=SAMPLE_RATE,
-            blocksize=BLOCKSIZE,
-            dtype="int16",
-            channels=1,
-            callback=callback,
-            device=sd.default.device,
-        ):
-            print("Escuchando wake word...")
-            while True:
-                try:
-                    data = q.get(timeout=1.0)  # Timeout para evitar bloqueo
-                except:
+    name = "template"
+    STRETCH = (0.8, 0.9, 1.0, 1.1, 1.25)
+
+    def __init__(self, templates: list, samplerate: int, threshold: float = WAKE_TEMPLATE_THRESHOLD) -> None:
+        self.mfcc = MfccExtractor(samplerate)
+        self.threshold = float(threshold)
+        self.templates = []
+        for audio in templates:
+            feats = MfccExtractor(samplerate).process(audio)
+            if feats.shape[0] >= 10:
+                self.templates.append(self._normalize(feats))
+        if not self.templates:
+            raise ValueError("No hay plantillas de wake word utilizables")
+        self.history = int(max(t.shape[0] for t in self.templates) * max(self.STRETCH)) + 1
+        self.reset()
+
+    @staticmethod
+    def _normalize(feats: np.ndarray) -> np.ndarray:
+        feats = feats - feats.mean(axis=-2, keepdims=True)
+        return feats / (np.linalg.norm(feats, axis=-1, keepdims=True) + 1e-6)
+
+    def reset(self) -> None:
+        self.mfcc.reset()
+        self._feats = np.zeros((0, self.mfcc.n_mfcc), dtype=np.float32)
+        self._frames_total = 0
+        self._refractory_until = 0
+        self.last_score = 0.0
+
+    def _best_match(self, n_new: int) -> Tuple[float, int]:
+        feats = self._feats
+        ends = np.arange(max(0, feats.shape[0] - n_new), feats.shape[0])
+        best, best_end = -1.0, -1
+        for tpl in self.templates:
+            length = tpl.shape[0]
+            for stretch in self.STRETCH:
+                span = int(round(length * stretch))
+                valid = ends[ends + 1 >= span]
+                if valid.size == 0:
                     continue
+                offsets = np.round(np.linspace(0, span - 1, length)).astype(int)
+                windows = self._normalize(feats[(valid - (span - 1))[:, None] + offsets[None, :]])
+                scores = np.einsum("etc,tc->e", windows, tpl) / length
+                i = int(np.argmax(scores))
+                if scores[i] > best:
+                    best, best_end = float(scores[i]), int(valid[i])
+        return best, best_end
+
+    def accept(self, data: bytes) -> Optional[WakeDetection]:
+        new = self.mfcc.process(np.frombuffer(data, dtype=np.int16))
+        if new.shape[0] == 0:
+            return None
+        self._feats = np.concatenate((self._feats, new))[-(self.history + new.shape[0]):]
+        self._frames_total += new.shape[0]
+        score, end = self._best_match(new.shape[0])
+        self.last_score = score
+        if score < self.threshold or end < 0:
+            return None
+        end_abs = self._frames_total - self._feats.shape[0] + end
+        if end_abs < self._refractory_until:
+            return None
+        self._refractory_until = end_abs + 100  # 1 s sin redisparos
+        end_s = (end_abs * self.mfcc.hop + self.mfcc.win) / float(self.mfcc.samplerate)
+        return WakeDetection(end_s, WAKE_WORD, False)
+
+
+def _load_wav_int16(path: str) -> Tuple[np.ndarray, int]:
+    """Lee un WAV PCM16 y lo devuelve en mono int16 junto a su sample rate."""
+    with wave.open(path, "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise ValueError(f"{path}: se esperaba PCM de 16 bit")
+        rate = wf.getframerate()
+        channels = wf.getnchannels()
+        audio = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return audio, rate
+
+
+_wake_templates: Optional[list] = None
+
+
+def _load_wake_templates() -> list:
+    """Carga (una vez) las plantillas WAV de WAKE_TEMPLATES_DIR recortando silencios."""
+    global _wake_templates
+    if _wake_templates is not None:
+        return _wake_templates
+    templates = []
+    if os.path.isdir(WAKE_TEMPLATES_DIR):
+        for name in sorted(os.listdir(WAKE_TEMPLATES_DIR)):
+            if not name.lower().endswith(".wav"):
+                continue
+            path = os.path.join(WAKE_TEMPLATES_DIR, name)
+            try:
+                audio, rate = _load_wav_int16(path)
+                audio = resample_int16(audio, rate, SAMPLE_RATE)
+                rate = SAMPLE_RATE
+                # Recortar silencio inicial/final con la energía por tramas de 10 ms
+                hop = max(1, rate // 100)
+                n = audio.size // hop
+                energy = np.mean(audio[:n * hop].reshape(n, hop).astype(np.float32) ** 2, axis=1)
+                loud = np.flatnonzero(energy > energy.max() * 10 ** (-35 / 10.0)) if n else np.zeros(0, dtype=int)
+                if loud.size:
+                    audio = audio[loud[0] * hop:(loud[-1] + 1) * hop]
+                templates.append(audio)
+            except Exception as exc:
+                print(f"[Wake] No se pudo leer la plantilla {name}: {exc}")
+    _wake_templates = templates
+    return templates
 
-                if recognizer.AcceptWaveform(data):
-                    res = json.loads(recognizer.Result())
-                    txt = res.get("text", "").lower().strip()
-                    if txt == WAKE_WORD:
-                        print(f"Wake word detectada: '{txt}'")
-                        # Pequeña pausa para evitar interferencia de audio residual
-                        time.sleep(0.25)
-                        return
+
+def _get_wake_model() -> vosk.Model:
+    """Modelo de Vosk para la wake word: el pequeño si existe, si no el principal."""
+    global _vosk_wake_model
+    if _vosk_wake_model is None and os.path.isdir(VOSK_WAKE_MODEL_DIR):
+        try:
+            _vosk_wake_model = vosk.Model(VOSK_WAKE_MODEL_DIR)
+            print(f"[Wake] Modelo pequeño cargado: {VOSK_WAKE_MODEL_DIR}")
+        except Exception as exc:
+            print(f"[Wake] No se pudo cargar {VOSK_WAKE_MODEL_DIR}: {exc}")
+    if _vosk_wake_model is not None:
+        return _vosk_wake_model
+    assert _vosk_model is not None
+    return _vosk_model
+
+
+def create_wake_engine() -> WakeWordEngine:
+    if WAKE_ENGINE == "template":
+        try:
+            return TemplateWakeEngine(_load_wake_templates(), SAMPLE_RATE)
+        except Exception as exc:
+            print(f"[Wake] Detector por plantillas no disponible ({exc}); usando Vosk")
+    model = _get_wake_model()
+    return VoskWakeEngine(model, "vosk-small" if model is _vosk_wake_model else "vosk")
+
+
+class RecognizerPool:
+    """Reconocedores construidos una sola vez y reutilizados entre turnos.
+
+    Construir un KaldiRecognizer (y compilar su gramática) cuesta; aquí se hace
+    al arrancar y cada turno solo paga un Reset(). Los tiempos de construcción
+    y de reset quedan en /metrics (startup.* y recognizer.*).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._wake: Optional[WakeWordEngine] = None
+        self._command: Optional[vosk.KaldiRecognizer] = None
+        self._grammar: Optional[vosk.KaldiRecognizer] = None
+        self._grammar_built = False
+
+    @staticmethod
+    def _timed(name: str, fn):
+        t0 = time.perf_counter()
+        obj = fn()
+        ms = 1000.0 * (time.perf_counter() - t0)
+        _metrics.observe(name, ms)
+        return obj, ms
+
+    def warm(self) -> None:
+        """Construye todo por adelantado e informa del coste."""
+        with self._lock:
+            parts = []
+            if self._wake is None:
+                self._wake, ms = self._timed("startup.wake_engine_ms", create_wake_engine)
+                parts.append(f"wake ({self._wake.name}) {ms:.0f} ms")
+            if self._command is None:
+                self._command, ms = self._timed("startup.command_recognizer_ms", create_recognizer)
+                parts.append(f"comando {ms:.0f} ms")
+            if not self._grammar_built:
+                self._grammar, ms = self._timed("startup.command_grammar_ms", create_command_grammar_recognizer)
+                self._grammar_built = True
+                if self._grammar is not None:
+                    parts.append(f"gramática de comandos {ms:.0f} ms")
+        if parts:
+            print(f"[Reconocedores] Construidos: {', '.join(parts)}")
+
+    def wake_engine(self) -> WakeWordEngine:
+        self.warm()
+        assert self._wake is not None
+        self._timed("recognizer.wake_reset_ms", self._wake.reset)
+        return self._wake
+
+    def command(self) -> vosk.KaldiRecognizer:
+        self.warm()
+        assert self._command is not None
+        self._timed("recognizer.command_reset_ms", self._command.Reset)
+        return self._command
+
+    def grammar(self) -> Optional[vosk.KaldiRecognizer]:
+        """Reconocedor de la primera pasada, o None si no está disponible."""
+        self.warm()
+        if self._grammar is not None:
+            self._timed("recognizer.grammar_reset_ms", self._grammar.Reset)
+        return self._grammar
+
+
+_recognizers = RecognizerPool()
+
+
+# =====================
+# Captura de audio persistente
+# =====================
+
+class AudioRingBuffer:
+    """Buffer circular int16 preasignado con las últimas muestras capturadas.
+
+    Las posiciones son absolutas (muestras desde el arranque de la captura),
+    así un consumidor puede pedir "todo desde la muestra N" mientras siga en
+    el buffer.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = max(1, int(capacity))
+        self._buf = np.zeros(self.capacity, dtype=np.int16)
+        self.total = 0  # muestras escritas desde el inicio
+
+    def write(self, samples: np.ndarray) -> None:
+        n = int(samples.size)
+        if n == 0:
+            return
+        # Si llega más de lo que cabe, solo importan las últimas 'capacity' muestras
+        skip = max(0, n - self.capacity)
+        m = n - skip
+        idx = (self.total + skip) % self.capacity
+        first = min(m, self.capacity - idx)
+        self._buf[idx:idx + first] = samples[skip:skip + first]
+        if first < m:
+            self._buf[:m - first] = samples[skip + first:]
+        self.total += n
+
+    def read_since(self, position: int) -> np.ndarray:
+        """Devuelve una copia de las muestras desde 'position' hasta ahora."""
+        start = max(int(position), self.total - self.capacity, 0)
+        n = self.total - start
+        if n <= 0:
+            return np.zeros(0, dtype=np.int16)
+        idx = start % self.capacity
+        first = min(n, self.capacity - idx)
+        out = np.empty(n, dtype=np.int16)
+        out[:first] = self._buf[idx:idx + first]
+        if first < n:
+            out[first:] = self._buf[:n - first]
+        return out
+
+
+class AudioCapture:
+    """Captura de micrófono persistente compartida por todas las fases.
+
+    Abre un único sd.RawInputStream al arrancar y entrega cada bloque al
+    consumidor activo (wake word, comando, ...). Cambiar de fase solo cambia
+    la cola suscrita; el dispositivo ALSA no se cierra ni se reabre. Todo lo
+    capturado pasa además por un buffer circular de pre-roll.
+    """
+
+    def __init__(self, samplerate: int, block_ms: int, device=None, preroll_secs: float = PREROLL_SECS,
+                 device_rate: Optional[int] = None) -> None:
+        self.samplerate = int(samplerate)
+        self.device_rate = int(device_rate or samplerate)
+        # El bloque del dispositivo debe dar un número entero de muestras a SAMPLE_RATE
+        mult = PolyphaseResampler.block_multiple(self.device_rate, self.samplerate)
+        self.device_blocksize = mult * max(1, round(self.device_rate * block_ms / 1000.0 / mult))
+        self.resampler: Optional[PolyphaseResampler] = None
+        if self.device_rate != self.samplerate:
+            self.resampler = PolyphaseResampler(self.device_rate, self.samplerate, self.device_blocksize)
+        self.blocksize = self.device_blocksize * self.samplerate // self.device_rate
+        # Anillo de buffers fijos: el callback copia cada bloque en el siguiente slot
+        # y entrega un memoryview. Hay slots de sobra para la cola acotada más los
+        # bloques que un consumidor junta en _read_chunk().
+        self.queue_blocks = max(2, CAPTURE_QUEUE_BLOCKS)
+        chunk_blocks = -(-self.samplerate * KALDI_CHUNK_MS // 1000 // self.blocksize)
+        self._slots = np.zeros((self.queue_blocks + chunk_blocks + 2, self.blocksize), dtype=np.int16)
+        self._slot_views = [memoryview(slot).cast("B") for slot in self._slots]
+        self._next_slot = 0
+        self._chunk = np.zeros((chunk_blocks + 1) * self.blocksize, dtype=np.int16)
+        self.device = device
+        self._stream: Optional[sd.RawInputStream] = None
+        self._lock = threading.Lock()
+        self._consumer: Optional["queue.Queue[AudioBlock]"] = None
+        self.ring = AudioRingBuffer(int(self.samplerate * max(0.5, preroll_secs)))
+        self.vad = FrameVAD(self.samplerate)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._stream is not None:
+                return
+            stream = sd.RawInputStream(
+                samplerate=self.device_rate,
+                blocksize=self.device_blocksize,
+                dtype="int16",
+                channels=1,
+                callback=self._callback,
+                device=self.device,
+            )
+            stream.start()
+            self._stream = stream
+        conv = f" → {self.samplerate}Hz (remuestreo en proceso)" if self.resampler else ""
+        print(f"[Captura] Micrófono abierto @ {self.device_rate}Hz{conv}, bloque {self.device_blocksize} muestras")
+
+    def stop(self) -> None:
+        with self._lock:
+            stream, self._stream = self._stream, None
+        if stream is None:
+            return
+        try:
+            stream.stop()
+        except Exception:
+            pass
+        try:
+            stream.close()
+        except Exception:
+            pass
+        print("[Captura] Micrófono cerrado")
+
+    def restart(self) -> None:
+        """Reabre el dispositivo; solo para recuperarse de errores del stream."""
+        self.stop()
+        self.start()
+
+    @property
+    def active(self) -> bool:
+        stream = self._stream
+        return stream is not None and bool(stream.active)
+
+    @property
+    def position(self) -> int:
+        """Muestras capturadas desde el arranque."""
+        return self.ring.total
+
+    def subscribe(self, since: Optional[int] = None) -> Tuple["queue.Queue[AudioBlock]", int]:
+        """Sustituye al consumidor activo por una cola nueva.
+
+        Si se indica 'since', la cola se precarga con el audio del pre-roll
+        desde esa muestra, sin huecos ni duplicados respecto a los bloques
+        siguientes. Devuelve (cola, posición de la primera muestra entregada).
+        """
+        q: "queue.Queue[AudioBlock]" = queue.Queue(maxsize=self.queue_blocks)
+        with self._lock:
+            start = self.ring.total
+            if since is not None:
+                preroll = self.ring.read_since(since)
+                if preroll.size:
+                    probs, speech = self.vad.analyze(preroll)
+                    q.put(AudioBlock(memoryview(preroll).cast("B"), probs, speech))
+                    start -= int(preroll.size)
+            self._consumer = q
+        return q, start
+
+    def read_range(self, start: int, end: int) -> np.ndarray:
+        """Copia del pre-roll entre las muestras absolutas [start, end)."""
+        with self._lock:
+            audio = self.ring.read_since(start)
+            first = self.ring.total - int(audio.size)
+        return audio[:max(0, int(end) - first)]
+
+    def unsubscribe(self, q: "queue.Queue[AudioBlock]") -> None:
+        with self._lock:
+            if self._consumer is q:
+                self._consumer = None
+
+    def _callback(self, indata, frames, t, status) -> None:
+        _metrics.incr("capture.blocks")
+        if status:
+            if status.input_overflow:
+                _metrics.incr("capture.input_overflow")
+            if status.input_underflow:
+                _metrics.incr("capture.input_underflow")
+        audio = np.frombuffer(indata, dtype=np.int16)
+        if self.resampler is not None:
+            audio = self.resampler.process(audio)
+        i = self._next_slot
+        self._next_slot = (i + 1) % len(self._slots)
+        slot = self._slots[i]
+        if audio.size != slot.size:
+            _metrics.incr("capture.bad_block_size")
+            return
+        np.copyto(slot, audio)
+        probs, speech = self.vad.process(slot)
+        with self._lock:
+            self.ring.write(slot)
+            q = self._consumer
+            if q is None:
+                return
+            block = AudioBlock(self._slot_views[i], probs, speech)
+            try:
+                q.put_nowait(block)
+            except queue.Full:
+                # Política: descartar el bloque más antiguo; el consumidor va con retraso
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                _metrics.incr("capture.dropped_blocks")
+                q.put_nowait(block)
+
+    def report(self) -> None:
+        """Imprime los contadores de desbordes/descartes si ha habido alguno."""
+        overflow = _metrics.counter("capture.input_overflow")
+        dropped = _metrics.counter("capture.dropped_blocks")
+        if overflow or dropped:
+            print(f"[Captura] Desbordes de entrada: {overflow:.0f}, bloques descartados por cola llena: {dropped:.0f}")
+
+
+_capture: Optional[AudioCapture] = None
+
+
+def start_capture() -> AudioCapture:
+    """Crea (una sola vez) y arranca la captura compartida del micrófono."""
+    global _capture
+    if _capture is None:
+        # El buffer cubre también un comando entero: la segunda pasada lo relee de ahí
+        _capture = AudioCapture(SAMPLE_RATE, max(5, CAPTURE_BLOCK_MS), sd.default.device,
+                                preroll_secs=max(PREROLL_SECS, MAX_COMMAND_SECS + 2), device_rate=CAPTURE_RATE)
+    _capture.start()
+    return _capture
+
+
+def get_capture_frame_ms() -> int:
+    """Duración de trama del VAD de la captura (o la configurada si aún no existe)."""
+    if _capture is not None:
+        return _capture.vad.frame_ms
+    return max(10, min(30, VAD_FRAME_MS))
+
+
+def _read_block(capture: AudioCapture, q: "queue.Queue[AudioBlock]", timeout: float) -> Optional[AudioBlock]:
+    """Lee un bloque de la cola suscrita; reabre el micrófono si el stream murió."""
+    try:
+        return q.get(timeout=timeout)
+    except queue.Empty:
+        if not capture.active:
+            print("[Captura] Stream inactivo, reabriendo micrófono...")
+            capture.restart()
+        return None
+
+
+def _read_chunk(capture: AudioCapture, q: "queue.Queue[AudioBlock]", timeout: float) -> Optional[AudioBlock]:
+    """Lee al menos KALDI_CHUNK_MS de audio juntando bloques pequeños del dispositivo.
+
+    Así el dispositivo puede trabajar con bloques de 20-50 ms (baja latencia)
+    sin pagar una llamada a Kaldi por bloque.
+    """
+    first = _read_block(capture, q, timeout)
+    if first is None:
+        return None
+    min_samples = capture.samplerate * KALDI_CHUNK_MS // 1000
+    n = len(first.data) // 2
+    if n >= min_samples:
+        return first
+    parts = [first]
+    while n < min_samples:
+        try:
+            block = q.get(timeout=timeout)
+        except queue.Empty:
+            break
+        parts.append(block)
+        n += len(block.data) // 2
+    if len(parts) == 1:
+        return first
+    probs = np.concatenate([p.probs for p in parts])
+    speech = np.concatenate([p.speech for p in parts])
+    if n > capture._chunk.size:
+        # Solo con un pre-roll grande delante: copia excepcional
+        return AudioBlock(memoryview(b"".join(p.data for p in parts)), probs, speech)
+    # Copiar al buffer de agrupación preasignado (válido hasta la siguiente lectura)
+    pos = 0
+    for p in parts:
+        m = len(p.data) // 2
+        capture._chunk[pos:pos + m] = np.frombuffer(p.data, dtype=np.int16)
+        pos += m
+    return AudioBlock(memoryview(capture._chunk[:pos]).cast("B"), probs, speech)
+
+
+_accept_buffers = True  # ¿acepta vosk buffers (memoryview) sin copiar a bytes?
+
+
+def _accept_waveform(recognizer: vosk.KaldiRecognizer, data) -> bool:
+    """AcceptWaveform con memoryview; si la versión de vosk solo admite bytes,
+    copia una vez y lo recuerda para no volver a intentarlo."""
+    global _accept_buffers
+    if _accept_buffers and not isinstance(data, bytes):
+        try:
+            return recognizer.AcceptWaveform(data)
+        except TypeError:
+            _accept_buffers = False
+            print("[Captura] vosk no acepta memoryview; se copiará cada bloque a bytes")
+    return recognizer.AcceptWaveform(bytes(data))
+
+
+def _grammar_confident(results: list, text: str) -> bool:
+    """¿Basta la primera pasada? Frase conocida completa, sin "[unk]" y con
+    todas las palabras por encima de COMMAND_GRAMMAR_MIN_CONF."""
+    if not text or "[unk]" in text or match_command_phrase(text) is None:
+        return False
+    confs = [float(w.get("conf", 0.0)) for r in results for w in (r.get("result") or [])]
+    return bool(confs) and min(confs) >= COMMAND_GRAMMAR_MIN_CONF
+
+
+def _decode_full(audio: np.ndarray) -> str:
+    """Transcribe un tramo completo con el modelo grande (segunda pasada)."""
+    if audio.size == 0:
+        return ""
+    recognizer = _recognizers.command()
+    t0 = time.perf_counter()
+    recognizer.AcceptWaveform(audio.tobytes())
+    try:
+        return json.loads(recognizer.FinalResult()).get("text", "").strip()
+    except Exception:
+        return ""
+    finally:
+        _metrics.observe("command.full_decode_ms", 1000.0 * (time.perf_counter() - t0))
+
+
+def _decode_oneshot_command(capture: AudioCapture, start: int, end: int) -> str:
+    """Transcribe el resto de la frase tras la wake word leyéndolo del pre-roll
+    (más rápido que tiempo real, sin volver a escuchar): primero con la
+    gramática de comandos y, si no es fiable, con el modelo completo."""
+    audio = capture.read_range(start, end)
+    if audio.size == 0:
+        return ""
+    grammar = _recognizers.grammar()
+    if grammar is not None:
+        t0 = time.perf_counter()
+        grammar.AcceptWaveform(audio.tobytes())
+        try:
+            res = json.loads(grammar.FinalResult())
+        except Exception:
+            res = {}
+        _metrics.observe("command.grammar_decode_ms", 1000.0 * (time.perf_counter() - t0))
+        text = res.get("text", "").strip()
+        if _grammar_confident([res], text):
+            _metrics.incr("command.grammar_hits")
+            print(f"[Comando] Gramática: '{text}'")
+            return text
+        _metrics.incr("command.grammar_fallbacks")
+    return _decode_full(audio)
+
+
+class WakeGate:
+    """Compuerta de energía delante del reconocedor de wake word.
+
+    Mientras el VAD no ve voz, el audio no se decodifica. Al abrirse, el bucle
+    de wake word alimenta también WAKE_GATE_LOOKBACK_MS de audio previo (desde
+    el pre-roll) para no cortar el inicio de la palabra; se cierra tras
+    WAKE_GATE_HANGOVER_MS de silencio. Lleva la cuenta del audio omitido y del
+    tiempo de decodificación para estimar el ahorro.
+    """
+
+    def __init__(self, samplerate: int, frame_ms: int) -> None:
+        self.samplerate = int(samplerate)
+        self.frame_ms = float(frame_ms)
+        self.open = False
+        self._silence_ms = 0.0
+        self.skipped_samples = 0
+        self.decoded_samples = 0
+        self.decode_secs = 0.0
+
+    def step(self, block: AudioBlock) -> str:
+        """Devuelve 'skip', 'open' (voz nueva), 'feed' o 'close' (último bloque)."""
+        speech = block.speech
+        n = len(block.data) // 2
+        if not self.open:
+            if speech.size and speech.any():
+                self.open = True
+                self._silence_ms = 0.0
+                return "open"
+            self.skipped_samples += n
+            return "skip"
+        if speech.size and speech.any():
+            self._silence_ms = (speech.size - 1 - int(np.flatnonzero(speech)[-1])) * self.frame_ms
+        else:
+            self._silence_ms += 1000.0 * n / self.samplerate
+        if self._silence_ms >= WAKE_GATE_HANGOVER_MS:
+            self.open = False
+            return "close"
+        return "feed"
+
+    def account(self, samples: int, secs: float) -> None:
+        self.decoded_samples += samples
+        self.decode_secs += secs
+
+    def report(self, engine_name: str = "") -> None:
+        """Vuelca la estadística acumulada a _metrics y la imprime."""
+        skipped = self.skipped_samples / self.samplerate
+        decoded = self.decoded_samples / self.samplerate
+        cost = self.decode_secs / decoded if decoded > 0 else 0.0
+        _metrics.incr("wake.skipped_audio_s", skipped)
+        _metrics.incr("wake.decoded_audio_s", decoded)
+        _metrics.incr("wake.decode_cpu_s", self.decode_secs)
+        _metrics.incr("wake.saved_decode_s", skipped * cost)
+        total = skipped + decoded
+        if total > 0:
+            print(
+                f"[Wake] Compuerta: {100.0 * skipped / total:.0f}% del audio sin decodificar "
+                f"(~{skipped * cost:.1f} s de decodificación ahorrados, coste {engine_name} {cost:.3f} s CPU/s audio)"
+            )
+        self.skipped_samples = 0
+        self.decoded_samples = 0
+        self.decode_secs = 0.0
+
+
+def _resolve_wake(capture: AudioCapture, engine: WakeWordEngine, det: WakeDetection, rec_start: int, consumed: int) -> Tuple[int, Optional[str]]:
+    """Traduce una detección a (muestra de fin de la wake word, comando one-shot)."""
+    wake_end = rec_start + int(det.end_s * capture.samplerate) if det.end_s is not None else consumed
+    # Latencia de detección: audio capturado desde que terminó la wake word
+    _metrics.observe("wake.detect_latency_ms", 1000.0 * (capture.position - wake_end) / capture.samplerate)
+    if not det.trailing:
+        print(f"Wake word detectada: '{det.text}' [{engine.name}]")
+        # Sin pausa: el audio posterior queda en el pre-roll
+        return wake_end, None
+    begin_turn()
+    command = _decode_oneshot_command(capture, wake_end, consumed)
+    print(f"Wake word detectada como prefijo: '{det.text}' → '{command}' [{engine.name}]")
+    # Si el resto es ininteligible, seguir como una activación normal
+    return wake_end, (command or None)
+
+
+def wait_for_wake_word() -> Tuple[int, Optional[str]]:
+    """Bloquea hasta oír la wake word.
+
+    Devuelve (muestra en la que terminó la wake word, comando). El comando solo
+    viene relleno en modo one-shot, cuando la wake word era el prefijo de una
+    frase más larga; si no, es None y hay que escuchar el comando aparte.
+    """
+    capture = start_capture()
+    engine = _recognizers.wake_engine()
+    q, rec_start = capture.subscribe()
+    consumed = rec_start
+    gate = WakeGate(capture.samplerate, capture.vad.frame_ms)
+    last_report = time.time()
+
+    def accept(data: bytes) -> Optional[WakeDetection]:
+        t0 = time.perf_counter()
+        det = engine.accept(data)
+        gate.account(len(data) // 2, time.perf_counter() - t0)
+        return det
+
+    try:
+        print("Escuchando wake word...")
+        while True:
+            if time.time() - last_report > 60.0:
+                gate.report(engine.name)
+                capture.report()
+                last_report = time.time()
+            block = _read_chunk(capture, q, timeout=1.0)  # Timeout para evitar bloqueo
+            if block is None:
+                continue
+            data = block.data
+            block_start = consumed
+            consumed += len(data) // 2
+
+            action = gate.step(block) if WAKE_GATE else "feed"
+            if action == "skip":
+                continue
+            if action == "open":
+                # Voz nueva: detector limpio + un poco de audio previo del pre-roll
+                engine.reset()
+                lookback = capture.read_range(block_start - capture.samplerate * WAKE_GATE_LOOKBACK_MS // 1000, block_start)
+                rec_start = block_start - int(lookback.size)
+                det = accept(lookback.tobytes()) if lookback.size else None
+                if det:
+                    return _resolve_wake(capture, engine, det, rec_start, block_start)
+
+            det = accept(data)
+            if det:
+                return _resolve_wake(capture, engine, det, rec_start, consumed)
+            if action == "close":
+                # Fin de la voz: forzar el resultado pendiente antes de dejar de decodificar
+                det = engine.flush()
+                if det:
+                    return _resolve_wake(capture, engine, det, rec_start, consumed)
     except Exception as exc:
         print(f"Error en wait_for_wake_word: {exc}")
         # Reintentar después de un breve delay
         time.sleep(1.0)
         return wait_for_wake_word()
+    finally:
+        capture.unsubscribe(q)
+        gate.report(engine.name)
 
 
-def listen_command(recognizer: vosk.KaldiRecognizer) -> str:
-    q: "queue.Queue[bytes]" = queue.Queue()
-    last_voice_ts = time.time()
-    start_ts = time.time()
+def listen_command(recognizer: vosk.KaldiRecognizer, since: Optional[int] = None,
+                   grammar: Optional[vosk.KaldiRecognizer] = None) -> str:
+    """Escucha un comando. Con 'since', el reconocedor arranca con el audio del
+    pre-roll desde esa muestra (p.ej. el final de la wake word).
 
-    def callback(indata, frames, t, status):
-        nonlocal last_voice_ts
-        if status:
-            pass
-        audio = np.frombuffer(indata, dtype=np.int16)
-        if _rms_int16(audio) > SILENCE_THRESHOLD:
-            last_voice_ts = time.time()
-        q.put(bytes(indata))
+    Con 'grammar' se decodifica primero solo contra las frases conocidas. Si
+    aparece "[unk]" se cambia en caliente al modelo completo, que se pone al día
+    con el audio ya capturado; si la gramática llega al final pero sin
+    confianza suficiente, el modelo completo decodifica la frase entera.
+    """
+    capture = start_capture()
+    endpointer = get_endpointer()
+    start_ts = time.time()
 
-    # Beep de inicio de escucha
+    # Beep de inicio de escucha; lo que se diga mientras suena queda en el pre-roll
     try:
         play_earcon("start_listen")
     except Exception:
         pass
+    # play_earcon() bloquea hasta que suena: lo captado hasta aquí (más la cola
+    # del eco) es el beep, que el VAD marcaría como voz
+    earcon_end = capture.position + capture.samplerate * EARCON_ECHO_MS // 1000
 
-    with sd.RawInputStream(
-        samplerate=SAMPLE_RATE,
-        blocksize=BLOCKSIZE,
-        dtype="int16",
-        channels=1,
-        callback=callback,
-        device=sd.default.device,
-    ):
+    _speculation.reset()
+    q, start_pos = capture.subscribe(since=since)
+    endpointer.reset(ignore_speech_ms=max(0.0, 1000.0 * (earcon_end - start_pos) / capture.samplerate))
+    try:
+        first_pass = grammar is not None
+        active = grammar if grammar is not None else recognizer
+        grammar_results: list = []
+        consumed = start_pos
+        decode_s = 0.0
         transcript = ""
-        while True:
-            # Fin por silencio o timeout máximo
-            if (time.time() - last_voice_ts) * 1000 > SILENCE_MS:
-                # Obtener resultado final acumulado
-                try:
-                    final = json.loads(recognizer.FinalResult())
-                    return final.get("text", "").strip()
-                except Exception:
-                    return transcript
-            if time.time() - start_ts > MAX_COMMAND_SECS:
-                try:
-                    final = json.loads(recognizer.FinalResult())
-                    return final.get("text", "").strip() or transcript
-                except Exception:
-                    return transcript
-
-            try:
-                data = q.get(timeout=0.2)
-            except Exception:
+        reason: Optional[str] = None
+        while reason is None:
+            block = _read_chunk(capture, q, timeout=0.2)
+            if block is None:
+                # Salvaguarda por si el micrófono deja de entregar audio
+                if time.time() - start_ts > MAX_COMMAND_SECS + 2:
+                    reason = "stall"
                 continue
-
-            if recognizer.AcceptWaveform(data):
-                res = json.loads(recognizer.Result())
+            consumed += len(block.data) // 2
+
+            t0 = time.perf_counter()
+            is_final = _accept_waveform(active, block.data)
+            if is_final:
+                res = json.loads(active.Result())
+                if first_pass:
+                    grammar_results.append(res)
                 part = res.get("text", "").strip()
                 if part:
                     transcript = (transcript + " " + part).strip()
+                hypothesis = transcript
             else:
-                # opcional: usar parcial para feedback
-                pass
-    # Beep de fin de escucha
-    try:
-        play_earcon("end_listen")
-    except Exception:
-        pass
+                partial = json.loads(active.PartialResult()).get("partial", "").strip()
+                hypothesis = (transcript + " " + partial).strip()
+
+            if first_pass and "[unk]" in hypothesis:
+                # Fuera de la gramática: el modelo completo se pone al día desde el inicio
+                first_pass = False
+                active = recognizer
+                _metrics.incr("command.grammar_fallbacks")
+                print("[Comando] Frase fuera de la gramática; paso al modelo completo")
+                is_final = active.AcceptWaveform(capture.read_range(start_pos, consumed).tobytes())
+                transcript = json.loads(active.Result()).get("text", "").strip() if is_final else ""
+                partial = "" if is_final else json.loads(active.PartialResult()).get("partial", "").strip()
+                hypothesis = (transcript + " " + partial).strip()
+            decode_s += time.perf_counter() - t0
+            reason = endpointer.update(block, final=is_final, hypothesis=hypothesis)
+            if reason is None:
+                _speculation.observe(hypothesis, endpointer.stable_ms)
+
+        # Desde aquí corre el presupuesto de latencia del turno
+        begin_turn()
+        noise_db = capture.vad.noise_db
+        print(
+            f"[Endpoint] Fin por '{reason}' tras {endpointer.elapsed_ms:.0f} ms de audio "
+            f"(voz {endpointer.speech_ms:.0f} ms, silencio final {endpointer.trailing_silence_ms:.0f} ms, "
+            f"ruido {noise_db if noise_db is not None else float('nan'):.1f} dB)"
+        )
+        # Obtener resultado final acumulado
+        t0 = time.perf_counter()
+        try:
+            res = json.loads(active.FinalResult())
+        except Exception:
+            res = {}
+        decode_s += time.perf_counter() - t0
+        text = (transcript + " " + res.get("text", "").strip()).strip()
+        if not first_pass:
+            _metrics.observe("command.full_decode_ms", 1000.0 * decode_s)
+            return text
+        _metrics.observe("command.grammar_decode_ms", 1000.0 * decode_s)
+        grammar_results.append(res)
+        if _grammar_confident(grammar_results, text):
+            _metrics.incr("command.grammar_hits")
+            print(f"[Comando] Gramática: '{text}'")
+            return text
+        if endpointer.speech_ms <= 0:
+            return ""
+        _metrics.incr("command.grammar_fallbacks")
+        return _decode_full(capture.read_range(start_pos, consumed))
+    finally:
+        capture.unsubscribe(q)
+        # Beep de fin de escucha
+        try:
+            play_earcon("end_listen")
+        except Exception:
+            pass
 
 
 def main() -> None:
@@ -1532,6 +4369,19 @@ def main() -> None:
     _config = load_config()
     # Lanzar siempre la UI de configuración en segundo plano
     start_config_server()
+    # Reconocedores construidos una vez; cada turno solo los resetea
+    _recognizers.warm()
+    # Salida de audio abierta una vez: los turnos no lanzan aplay ni abren el dispositivo
+    start_output_sink()
+    # Avisos de error ya sintetizados para responder al instante si algo remoto cae
+    prepare_canned_phrases()
+    # Modelo de Ollama residente antes del primer turno y vigilancia de los servidores
+    warm_up_ollama()
+    _ollama_pool.start_health_checks()
+    # Índice del enrutador de intenciones (desde disco si no han cambiado los ejemplos)
+    get_intent_router()
+    # Micrófono persistente: se abre una vez y lo comparten todas las fases
+    start_capture()
     print("Asistente listo. Di 'asistente' para activar.")
     
     # Reproducir pitido de inicio
@@ -1547,14 +4397,21 @@ def main() -> None:
         if now < cooldown_end_ts:
             time.sleep(max(0.0, cooldown_end_ts - now))
 
-        # Esperar wake word
-        wait_for_wake_word()
-        print("[Wake word] detectada - cambiando a modo comando")
+        # Esperar wake word (sin especulaciones ni presupuesto del turno anterior)
+        _speculation.reset()
+        end_turn()
+        wake_end, oneshot_command = wait_for_wake_word()
+        if oneshot_command:
+            # Wake word + comando en la misma frase: sin beep ni segunda escucha
+            print("[Wake word] detectada con comando en la misma frase")
+            command = oneshot_command
+        else:
+            print("[Wake word] detectada - cambiando a modo comando")
 
-        # Crear nuevo recognizer para el comando
-        command_recognizer = create_recognizer()
-        print("[Escuchando comando] (habla ahora)")
-        command = listen_command(command_recognizer)
+            # Reconocedor de comandos reutilizado (solo se resetea)
+            command_recognizer = _recognizers.command()
+            print("[Escuchando comando] (habla ahora)")
+            command = listen_command(command_recognizer, since=wake_end, grammar=_recognizers.grammar())
         print(f"[Comando recibido]: '{command}'")
 
         if not command:
@@ -1562,9 +4419,34 @@ def main() -> None:
             cooldown_end_ts = time.time() + 1.0
             continue
 
-        # Detección de intención con IA (fallback a heurística si falla)
-        intent, _extras = classify_intent_via_llm(command)
-        if intent == "weather":
+        budget = current_budget() or begin_turn()
+        budget.stage("stt")
+
+        # Frase conocida: intención directa; si no, detección con IA (fallback a heurística si falla)
+        known = match_command_phrase(command)
+        speculated = _speculation.resolve(command) if known is None else None
+        early_reply: Optional[str] = None
+        if known is not None:
+            intent, _extras = known
+            print(f"[Intent] Frase conocida → {intent} (sin clasificación por IA)")
+        elif speculated is not None:
+            intent, _extras = speculated
+        else:
+            routed = route_intent(command)
+            if routed is not None:
+                intent, _extras = routed
+            elif PARALLEL_ANSWER:
+                # Clasificación por IA y respuesta general a la vez
+                intent, _extras, early_reply = classify_with_parallel_answer(command)
+            else:
+                intent, _extras = classify_intent_via_llm(command)
+        budget.stage("classify")
+        if early_reply is not None:
+            reply = early_reply
+        elif _extras.get("reply"):
+            reply = _extras["reply"]
+            speak(reply)
+        elif intent == "weather":
             print("[Intent] Consulta de clima detectada")
             reply = handle_weather_command(command, when=_extras.get("when"))
             print(f"[IA resumen clima]: '{reply[:200]}...'")
@@ -1582,11 +4464,16 @@ def main() -> None:
             try:
                 reply = stream_and_speak_from_ollama(messages)
             except Exception as exc:
-                error = f"Hubo un error consultando el modelo: {exc}"
+                error = FailedReply(f"Hubo un error consultando el modelo: {exc}")
                 print(f"[Error IA]: '{error}'")
                 reply = error
 
         print(f"[Respuesta IA]: '{reply[:300]}...'")  # Primeros 300 chars
+        end_turn()
+        # Solo respuestas reales del modelo o de una herramienta: los avisos y
+        # errores (FailedReply) no entran en el historial
+        if reply and not isinstance(reply, FailedReply):
+            _session.record(command, reply)
 
         # Cooldown antes de volver a esperar wake word
         cooldown_end_ts = time.time() + 2.0
@@ -1598,4 +4485,7 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print("\nSaliendo...")
+    finally:
+        if _capture is not None:
+            _capture.stop()
 
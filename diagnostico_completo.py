@@ -128,6 +128,31 @@ def check_ollama():
         print(f"  ✗ Error Ollama: {str(e)[:50]}...")
         return False
 
+def check_audio_route():
+    """Muestra la ruta de salida de audio que sondeó el asistente"""
+    print("🔊 VERIFICANDO SALIDA DE AUDIO...")
+
+    path = os.getenv("AUDIO_ROUTE_PATH", os.path.join(BASE_DIR, "models", "audio_route.json"))
+    if not os.path.exists(path):
+        print("  ⚠ Aún sin sondear (se hará al arrancar el asistente)")
+        return True
+
+    try:
+        import json
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for attempt in data.get("tried", []):
+            icon = "✓" if attempt.get("ok") else "✗"
+            print(f"  {icon} {attempt.get('route')}")
+        route = data.get("route", {})
+        print(f"  → En uso: {route.get('backend')} {route.get('device') or 'default'} "
+              f"@ {route.get('rate')} Hz, {route.get('channels')} canal(es) "
+              f"(sondeada {data.get('probed_at', '?')})")
+        return any(a.get("ok") for a in data.get("tried", []))
+    except Exception as e:
+        print(f"  ✗ Ruta de audio ilegible: {str(e)[:50]}...")
+        return False
+
 def main():
     print("🔍 DIAGNÓSTICO COMPLETO DEL ASISTENTE IA")
     print("=" * 50)
@@ -146,6 +171,9 @@ def main():
     # 4. Ollama
     results['ollama'] = check_ollama()
 
+    # 5. Salida de audio
+    results['audio'] = check_audio_route()
+
     # Resumen
     print("\n" + "=" * 50)
     print("RESUMEN:")
@@ -155,6 +183,7 @@ def main():
         ("Archivos", results.get('files', False)),
         ("Piper", results.get('piper', False)),
         ("Ollama", results.get('ollama', False)),
+        ("Audio", results.get('audio', False)),
     ]
 
     all_ok = True
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+EVALUACIÓN DEL DETECTOR DE WAKE WORD
+Mide el coste de CPU, la latencia de detección y las tasas de falsa
+aceptación / falso rechazo del detector configurado sobre un conjunto
+de WAVs etiquetados.
+
+Estructura esperada (WAV PCM 16 bit; se remuestrean a 16 kHz si hace falta):
+  <dir>/positivos/*.wav   grabaciones que contienen la wake word
+  <dir>/negativos/*.wav   grabaciones sin la wake word (conversación, ruido, TV...)
+
+Uso:
+  python3 evaluar_wake.py <dir> [--engine vosk|template] [--block-ms 20,50,100,500]
+
+Con varios --block-ms se compara latencia de detección frente a coste de
+CPU para elegir CAPTURE_BLOCK_MS/KALDI_CHUNK_MS en cada placa.
+"""
+import os
+import sys
+import time
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evalúa el detector de wake word")
+    parser.add_argument("dataset", help="Carpeta con positivos/ y negativos/")
+    parser.add_argument("--engine", choices=["vosk", "template"], help="Detector a evaluar (por defecto WAKE_ENGINE)")
+    parser.add_argument("--block-ms", default="", help="Tamaños de bloque a comparar, p.ej. 20,50,100,500 (por defecto KALDI_CHUNK_MS)")
+    return parser.parse_args()
+
+
+def list_wavs(folder):
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, n) for n in sorted(os.listdir(folder)) if n.lower().endswith(".wav")]
+
+
+def run_file(assistant, engine, vad, path, block_ms):
+    """Pasa un WAV por VAD + detector en bloques como en la captura real.
+    Devuelve (nº de detecciones, segundos de audio, CPU detector, CPU VAD, latencias en ms)."""
+    audio, rate = assistant._load_wav_int16(path)
+    # Igual que la captura: todo llega al detector a SAMPLE_RATE
+    audio = assistant.resample_int16(audio, rate, assistant.SAMPLE_RATE)
+    rate = assistant.SAMPLE_RATE
+    engine.reset()
+    block = max(1, rate * block_ms // 1000)
+    detections = 0
+    cpu = 0.0
+    cpu_vad = 0.0
+    latencies = []
+    for i in range(0, audio.size, block):
+        chunk = audio[i:i + block]
+        t0 = time.process_time()
+        vad.process(chunk)
+        cpu_vad += time.process_time() - t0
+        t0 = time.process_time()
+        det = engine.accept(chunk.tobytes())
+        spent = time.process_time() - t0
+        cpu += spent
+        if det:
+            detections += 1
+            if det.end_s is not None:
+                # Audio pendiente tras el fin de la wake word + lo que tardó el detector
+                latencies.append(1000.0 * ((i + chunk.size) / float(rate) - det.end_s + spent))
+    t0 = time.process_time()
+    if engine.flush():
+        detections += 1
+    cpu += time.process_time() - t0
+    return detections, audio.size / float(rate), cpu, cpu_vad, latencies
+
+
+def evaluate(assistant, engine, positives, negatives, block_ms):
+    vad = assistant.FrameVAD(assistant.SAMPLE_RATE)
+    misses = 0
+    false_accepts = 0
+    neg_files_with_fa = 0
+    audio_total = 0.0
+    neg_audio = 0.0
+    cpu_total = 0.0
+    cpu_vad_total = 0.0
+    latencies = []
+    for path in positives:
+        detections, secs, cpu, cpu_vad, lat = run_file(assistant, engine, vad, path, block_ms)
+        audio_total += secs
+        cpu_total += cpu
+        cpu_vad_total += cpu_vad
+        latencies += lat[:1]
+        if detections == 0:
+            misses += 1
+            print(f"  ✗ Falso rechazo: {os.path.basename(path)}")
+    for path in negatives:
+        detections, secs, cpu, cpu_vad, _ = run_file(assistant, engine, vad, path, block_ms)
+        audio_total += secs
+        neg_audio += secs
+        cpu_total += cpu
+        cpu_vad_total += cpu_vad
+        if detections:
+            false_accepts += detections
+            neg_files_with_fa += 1
+            print(f"  ✗ Falsa aceptación ({detections}): {os.path.basename(path)}")
+
+    print(f"\nRESUMEN (bloques de {block_ms} ms):")
+    if positives:
+        print(f"  Falso rechazo:     {100.0 * misses / len(positives):.1f}% ({misses}/{len(positives)})")
+    if negatives:
+        per_hour = false_accepts / (neg_audio / 3600.0) if neg_audio > 0 else 0.0
+        print(f"  Falsa aceptación:  {100.0 * neg_files_with_fa / len(negatives):.1f}% de ficheros ({false_accepts} en total, {per_hour:.1f}/hora)")
+    if latencies:
+        latencies.sort()
+        p90 = latencies[min(len(latencies) - 1, int(0.9 * len(latencies)))]
+        print(f"  Latencia:          media {sum(latencies) / len(latencies):.0f} ms, p90 {p90:.0f} ms")
+    if audio_total > 0:
+        print(f"  Coste de CPU:      detector {cpu_total / audio_total:.3f} s/s, VAD {cpu_vad_total / audio_total:.4f} s/s ({audio_total:.1f} s de audio)")
+    return {
+        "block_ms": block_ms,
+        "frr": misses / len(positives) if positives else 0.0,
+        "latency_ms": sum(latencies) / len(latencies) if latencies else float("nan"),
+        "cpu": (cpu_total + cpu_vad_total) / audio_total if audio_total > 0 else 0.0,
+    }
+
+
+def main():
+    args = parse_args()
+    if args.engine:
+        os.environ["WAKE_ENGINE"] = args.engine
+    import assistant
+    import vosk
+
+    # Cargar el modelo principal solo si la wake word no tiene modelo propio
+    if assistant.WAKE_ENGINE == "vosk" and not os.path.isdir(assistant.VOSK_WAKE_MODEL_DIR):
+        assistant._vosk_model = vosk.Model(assistant.VOSK_MODEL_DIR)
+    engine = assistant.create_wake_engine()
+
+    positives = list_wavs(os.path.join(args.dataset, "positivos"))
+    negatives = list_wavs(os.path.join(args.dataset, "negativos"))
+    if not positives and not negatives:
+        print("No se encontraron WAVs en positivos/ ni negativos/")
+        return False
+    sizes = [int(x) for x in args.block_ms.split(",") if x.strip()] or [assistant.KALDI_CHUNK_MS]
+
+    print(f"🎯 EVALUANDO DETECTOR '{engine.name}' (wake word '{assistant.WAKE_WORD}')")
+    print("=" * 50)
+    results = [evaluate(assistant, engine, positives, negatives, ms) for ms in sizes]
+
+    if len(results) > 1:
+        print("\n" + "=" * 50)
+        print("LATENCIA vs CPU:")
+        print("  bloque ms | latencia media ms | CPU s/s | falso rechazo")
+        for r in results:
+            print(f"  {r['block_ms']:>9} | {r['latency_ms']:>17.0f} | {r['cpu']:>7.3f} | {100.0 * r['frr']:>12.1f}%")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+PRUEBA DEL POOL DE SERVIDORES DE OLLAMA
+Levanta dos servidores Ollama de mentira en local y comprueba que OllamaPool:
+  - ve a los dos sanos (/api/tags con el modelo),
+  - si el primero se atasca a mitad de respuesta, la termina en el otro
+    enviándole lo ya recibido como inicio del mensaje del asistente,
+  - marca caído al que se atascó y manda ahí las siguientes peticiones.
+
+No necesita Ollama ni red: todo va contra 127.0.0.1.
+
+Uso:
+  python3 probar_ollama_pool.py [--stall-secs 1.0]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MODEL = "llama3.2:3b"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prueba el failover de OllamaPool con servidores locales")
+    parser.add_argument("--stall-secs", type=float, default=1.0, help="OLLAMA_STALL_SECS para la prueba (por defecto 1.0)")
+    return parser.parse_args()
+
+
+class StandInServer:
+    """Servidor que imita /api/tags y /api/chat (NDJSON en streaming).
+    Con stall=True entrega las primeras palabras y luego deja de responder."""
+
+    def __init__(self, words, stall_secs=0.0):
+        self.words = words
+        self.stall_secs = stall_secs
+        self.requests = []  # mensajes recibidos en cada /api/chat
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _chunk(self, content, done, **extra):
+                msg = {"model": MODEL, "created_at": "2024-01-01T00:00:00Z",
+                       "message": {"role": "assistant", "content": content}, "done": done}
+                msg.update(extra)
+                self.wfile.write((json.dumps(msg) + "\n").encode())
+                self.wfile.flush()
+
+            def do_GET(self):
+                body = json.dumps({"models": [{"name": MODEL}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(payload.get("messages", []))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                try:
+                    for word in server.words:
+                        self._chunk(word, False)
+                    if server.stall_secs:
+                        # Atasco a mitad de respuesta: la conexión sigue abierta sin datos
+                        time.sleep(server.stall_secs)
+                        return
+                    self._chunk("", True, eval_count=len(server.words), eval_duration=int(2e8))
+                except Exception:
+                    pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+
+def report(name, ok, detail=""):
+    print(f"  {'✓' if ok else '✗'} {name}{': ' + detail if detail else ''}")
+    return ok
+
+
+def main():
+    args = parse_args()
+    # Tiene que fijarse antes de importar: los clientes de Ollama leen el timeout al crearse
+    os.environ["OLLAMA_STALL_SECS"] = str(args.stall_secs)
+    import assistant
+
+    stalling = StandInServer(["Hola, ", "soy "], stall_secs=args.stall_secs * 3)
+    healthy = StandInServer(["Kubik, ", "tu asistente."])
+    pool = assistant.OllamaPool([stalling.url, healthy.url], MODEL)
+
+    print("🧪 PROBANDO OllamaPool CON SERVIDORES LOCALES")
+    print("=" * 50)
+    results = []
+
+    health = [pool.check(b) for b in pool.backends]
+    results.append(report("Comprobación de salud", all(health), f"{health}"))
+
+    question = [{"role": "user", "content": "¿Quién eres?"}]
+    t0 = time.perf_counter()
+    try:
+        reply = pool.chat(question)["message"]["content"]
+    except Exception as exc:
+        reply = f"<error: {exc}>"
+    elapsed = time.perf_counter() - t0
+    results.append(report("Respuesta completada tras el atasco", reply == "Hola, soy Kubik, tu asistente.",
+                          f"'{reply}' en {elapsed:.1f} s"))
+
+    prefill = healthy.requests[0][-1] if healthy.requests else {}
+    results.append(report("El segundo servidor continúa lo ya recibido",
+                          prefill.get("role") == "assistant" and prefill.get("content") == "Hola, soy ",
+                          f"{prefill}"))
+    results.append(report("Sin esperar al atasco completo", elapsed < args.stall_secs * 3,
+                          f"{elapsed:.1f} s (límite {args.stall_secs:.1f} s sin datos)"))
+
+    backend = next(b for b in pool.backends if b.host == stalling.url)
+    results.append(report("Servidor atascado marcado como caído", not backend.healthy))
+
+    before = len(stalling.requests)
+    try:
+        second = pool.chat(question)["message"]["content"]
+    except Exception as exc:
+        second = f"<error: {exc}>"
+    results.append(report("La siguiente petición va directa al sano",
+                          len(stalling.requests) == before and second == "Kubik, tu asistente.", f"'{second}'"))
+
+    print("\n" + "=" * 50)
+    all_ok = all(results)
+    print("🎉 Failover correcto" if all_ok else "⚠️  El pool no se comportó como se esperaba")
+    return all_ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)